@@ -0,0 +1,321 @@
+import argparse
+import concurrent.futures
+import fnmatch
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+import pyarrow
+import pyarrow.csv
+import pyarrow.parquet
+
+from epc import compression_options, convert_datasets, epc_datasets
+from generate_epc_zip import generate_epc_zip
+
+# Benchmarks converting a generated zip. convert_datasets runs every stage
+# fused together, so each stage is also timed on its own, member by member:
+#
+#   inflate   decompressing the zip member           MB of CSV
+#   parse     splitting CSV into string columns      MB of CSV
+#   convert   casting string columns to the schema   MB of CSV
+#   encode    encoding and compressing Parquet       MB of Arrow data
+#   write     writing the Parquet to disk            MB of Parquet
+#
+# Results are written as JSON so a run on one commit can be compared with a
+# baseline from another.
+
+STAGES = ["inflate", "parse", "convert", "encode", "write"]
+
+
+# Peak resident set size, in MB, of this process or of the largest of its
+# children that have finished, such as conversion workers. ru_maxrss is in
+# kilobytes on Linux but bytes on macOS.
+def peak_rss_mb():
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def throughput(seconds, rows, size):
+    return {
+        "seconds": seconds,
+        "rows": rows,
+        "mb": size / 1024**2,
+        "rows_per_second": rows / seconds if seconds else None,
+        "mb_per_second": size / 1024**2 / seconds if seconds else None,
+    }
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+# Times each stage on every member matching a dataset, keeping each stage's
+# output in memory so the next stage starts from it.
+def time_stages(zip_path, file_pattern, schema, output_path, compression):
+    seconds = dict.fromkeys(STAGES, 0.0)
+    sizes = dict.fromkeys(STAGES, 0)
+    rows = 0
+    os.makedirs(output_path, exist_ok=True)
+    with zipfile.ZipFile(zip_path) as zip_file:
+        members = [
+            member
+            for member in zip_file.infolist()
+            if fnmatch.fnmatch(member.filename, file_pattern)
+        ]
+        for number, member in enumerate(members):
+            elapsed, csv_bytes = timed(zip_file.read, member)
+            seconds["inflate"] += elapsed
+            sizes["inflate"] += len(csv_bytes)
+
+            # Every column is read as nullable strings, so parsing does not
+            # include converting them.
+            elapsed, strings = timed(
+                pyarrow.csv.read_csv,
+                pyarrow.py_buffer(csv_bytes),
+                convert_options=pyarrow.csv.ConvertOptions(
+                    column_types={name: pyarrow.string() for name in schema},
+                    strings_can_be_null=True,
+                ),
+            )
+            seconds["parse"] += elapsed
+            sizes["parse"] += len(csv_bytes)
+            rows += strings.num_rows
+
+            target = pyarrow.schema(
+                [
+                    (name, schema.get(name, pyarrow.string()))
+                    for name in strings.column_names
+                ]
+            )
+            elapsed, table = timed(strings.cast, target)
+            seconds["convert"] += elapsed
+            sizes["convert"] += len(csv_bytes)
+
+            def encode():
+                sink = pyarrow.BufferOutputStream()
+                pyarrow.parquet.write_table(
+                    table,
+                    sink,
+                    **compression_options(table.schema, compression, None, None),
+                )
+                return sink.getvalue()
+
+            elapsed, parquet_bytes = timed(encode)
+            seconds["encode"] += elapsed
+            sizes["encode"] += table.nbytes
+
+            def write():
+                path = os.path.join(output_path, f"part-{number:03}.parquet")
+                with open(path, "wb") as parquet_file:
+                    parquet_file.write(parquet_bytes)
+                    parquet_file.flush()
+                    os.fsync(parquet_file.fileno())
+
+            elapsed, _ = timed(write)
+            seconds["write"] += elapsed
+            sizes["write"] += parquet_bytes.size
+    return seconds, sizes, rows
+
+
+# Runs the conversion the CLI would, in a fresh process so its peak RSS is its
+# own rather than left over from timing the stages. The process is spawned
+# rather than forked, since a forked child's RSS counts the pages it shares
+# with the parent.
+def run_conversion(zip_path, output_path, options):
+    start = time.perf_counter()
+    convert_datasets(zip_path, epc_datasets(output_path), **options)
+    return time.perf_counter() - start, peak_rss_mb()
+
+
+def benchmark(zip_path, work_path, repeat=1, **options):
+    with zipfile.ZipFile(zip_path) as zip_file:
+        csv_size = sum(member.file_size for member in zip_file.infolist())
+
+    datasets = {}
+    for file_pattern, schema, dataset_path, _ in epc_datasets(work_path):
+        name = os.path.basename(dataset_path)
+        best = None
+        for _ in range(repeat):
+            seconds, sizes, rows = time_stages(
+                zip_path,
+                file_pattern,
+                schema,
+                os.path.join(work_path, "stages", name),
+                options.get("compression", "snappy"),
+            )
+            if best is None or sum(seconds.values()) < sum(best[0].values()):
+                best = seconds, sizes, rows
+        seconds, sizes, rows = best
+        datasets[name] = {
+            stage: throughput(seconds[stage], rows, sizes[stage]) for stage in STAGES
+        }
+
+    stages_rss = peak_rss_mb()
+
+    conversion_seconds = None
+    for _ in range(repeat):
+        output_path = os.path.join(work_path, "converted")
+        shutil.rmtree(output_path, ignore_errors=True)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            seconds, conversion_rss = executor.submit(
+                run_conversion, zip_path, output_path, options
+            ).result()
+        conversion_seconds = min(conversion_seconds or seconds, seconds)
+    total_rows = sum(stages["parse"]["rows"] for stages in datasets.values())
+
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pyarrow": pyarrow.__version__,
+        "zip": {
+            "path": os.path.basename(zip_path),
+            "size_mb": os.path.getsize(zip_path) / 1024**2,
+            "csv_mb": csv_size / 1024**2,
+        },
+        "options": {name: repr(value) for name, value in options.items()},
+        "stages": datasets,
+        "conversion": {
+            **throughput(conversion_seconds, total_rows, csv_size),
+            "peak_rss_mb": conversion_rss,
+        },
+        "stages_peak_rss_mb": stages_rss,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Lists every throughput that fell by more than threshold, as a fraction of the
+# baseline's, along with peak RSS of the conversion growing by more than it.
+def compare_results(baseline, results, threshold=0.1):
+    regressions = []
+    for dataset, stages in results["stages"].items():
+        for stage, result in stages.items():
+            before = baseline["stages"].get(dataset, {}).get(stage)
+            if before and before["mb_per_second"] and result["mb_per_second"]:
+                change = result["mb_per_second"] / before["mb_per_second"] - 1
+                if change < -threshold:
+                    regressions.append((f"{dataset} {stage}", change))
+    before, after = baseline["conversion"], results["conversion"]
+    if before["mb_per_second"] and after["mb_per_second"]:
+        change = after["mb_per_second"] / before["mb_per_second"] - 1
+        if change < -threshold:
+            regressions.append(("conversion", change))
+    if before["peak_rss_mb"] and after["peak_rss_mb"]:
+        change = after["peak_rss_mb"] / before["peak_rss_mb"] - 1
+        if change > threshold:
+            regressions.append(("conversion peak RSS", change))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print(
+        f"{'stage':<28} {'rows/s':>12} {'MB/s':>10} {'seconds':>9}"
+        + (f" {'vs baseline':>12}" if baseline else "")
+    )
+
+    def row(label, result, before):
+        line = (
+            f"{label:<28} {result['rows_per_second'] or 0:>12,.0f} "
+            f"{result['mb_per_second'] or 0:>10.1f} {result['seconds']:>9.2f}"
+        )
+        if before and before["mb_per_second"] and result["mb_per_second"]:
+            line += f" {result['mb_per_second'] / before['mb_per_second'] - 1:>+12.1%}"
+        print(line)
+
+    for dataset, stages in results["stages"].items():
+        for stage, result in stages.items():
+            before = baseline and baseline["stages"].get(dataset, {}).get(stage)
+            row(f"{dataset} {stage}", result, before)
+    row("conversion", results["conversion"], baseline and baseline["conversion"])
+    print(f"Peak RSS of conversion {results['conversion']['peak_rss_mb']:,.0f} MB")
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark converting a generated EPC zip to Parquet"
+    )
+    parser.add_argument(
+        "--size",
+        type=float,
+        default=100,
+        help="megabytes of uncompressed CSV to generate",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--data-dir",
+        default=".benchmark",
+        help="where generated zips are kept between runs",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="keep the best of N")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--block-size", type=int)
+    parser.add_argument("--compression", default="snappy")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument(
+        "--compare",
+        help="compare with the results in this JSON file, exiting with status 1 "
+        "if anything regressed by more than --threshold",
+    )
+    parser.add_argument("--threshold", type=float, default=0.1)
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    os.makedirs(args.data_dir, exist_ok=True)
+    zip_path = os.path.join(args.data_dir, f"epc-{args.size:g}mb-{args.seed}.zip")
+    if not os.path.exists(zip_path):
+        generate_epc_zip(zip_path + ".tmp", args.size, args.seed)
+        os.replace(zip_path + ".tmp", zip_path)
+
+    with tempfile.TemporaryDirectory(dir=args.data_dir) as work_path:
+        results = benchmark(
+            zip_path,
+            work_path,
+            repeat=args.repeat,
+            workers=args.workers,
+            block_size=args.block_size,
+            compression=args.compression,
+        )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+
+    if baseline:
+        regressions = compare_results(baseline, results, args.threshold)
+        for label, change in regressions:
+            print(f"Regression: {label} {change:+.1%}")
+        sys.exit(1 if regressions else 0)
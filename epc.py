@@ -1,12 +1,35 @@
 import argparse
+import ast
+import bisect
+import concurrent.futures
+import contextlib
+import datetime
 import fnmatch
+import functools
+import hashlib
+import heapq
+import json
+import math
+import operator
 import os
+import posixpath
+import re
+import shutil
+import tempfile
+import time
 import zipfile
 
 import pyarrow
+import pyarrow.compute
 import pyarrow.csv
+import pyarrow.dataset
+import pyarrow.ipc
 import pyarrow.parquet
 
+# Low cardinality strings are read as dictionary arrays straight from the CSV and
+# stay dictionary encoded in Parquet, so readers get categoricals back.
+CATEGORY = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+
 # https://epc.opendatacommunities.org/docs/guidance#glossary_domestic
 # LMK_KEY is a string - first few rows look like integers
 # Docs say `*_{CURRENT,POTENTIAL}` cols are integers but found floats
@@ -17,18 +40,18 @@ CERTIFICATE_SCHEMA = {
     "ADDRESS3": pyarrow.string(),
     "POSTCODE": pyarrow.string(),
     "BUILDING_REFERENCE_NUMBER": pyarrow.int64(),
-    "CURRENT_ENERGY_RATING": pyarrow.string(),
-    "POTENTIAL_ENERGY_RATING": pyarrow.string(),
+    "CURRENT_ENERGY_RATING": CATEGORY,
+    "POTENTIAL_ENERGY_RATING": CATEGORY,
     "CURRENT_ENERGY_EFFICIENCY": pyarrow.int64(),
     "POTENTIAL_ENERGY_EFFICIENCY": pyarrow.int64(),
-    "PROPERTY_TYPE": pyarrow.string(),
-    "BUILT_FORM": pyarrow.string(),
+    "PROPERTY_TYPE": CATEGORY,
+    "BUILT_FORM": CATEGORY,
     "INSPECTION_DATE": pyarrow.date32(),
-    "LOCAL_AUTHORITY": pyarrow.string(),
-    "CONSTITUENCY": pyarrow.string(),
-    "COUNTY": pyarrow.string(),
+    "LOCAL_AUTHORITY": CATEGORY,
+    "CONSTITUENCY": CATEGORY,
+    "COUNTY": CATEGORY,
     "LODGEMENT_DATE": pyarrow.date32(),
-    "TRANSACTION_TYPE": pyarrow.string(),
+    "TRANSACTION_TYPE": CATEGORY,
     "ENVIRONMENT_IMPACT_CURRENT": pyarrow.float64(),
     "ENVIRONMENT_IMPACT_POTENTIAL": pyarrow.float64(),
     "ENERGY_CONSUMPTION_CURRENT": pyarrow.float64(),
@@ -43,66 +66,66 @@ CERTIFICATE_SCHEMA = {
     "HOT_WATER_COST_CURRENT": pyarrow.float64(),
     "HOT_WATER_COST_POTENTIAL": pyarrow.float64(),
     "TOTAL_FLOOR_AREA": pyarrow.float64(),
-    "ENERGY_TARIFF": pyarrow.string(),
-    "MAINS_GAS_FLAG": pyarrow.string(),
+    "ENERGY_TARIFF": CATEGORY,
+    "MAINS_GAS_FLAG": CATEGORY,
     "FLOOR_LEVEL": pyarrow.string(),
-    "FLAT_TOP_STOREY": pyarrow.string(),
+    "FLAT_TOP_STOREY": CATEGORY,
     "FLAT_STOREY_COUNT": pyarrow.int64(),
     "MAIN_HEATING_CONTROLS": pyarrow.string(),
     "MULTI_GLAZE_PROPORTION": pyarrow.float64(),  # int but values are floats, e.g 1.0
-    "GLAZED_TYPE": pyarrow.string(),
-    "GLAZED_AREA": pyarrow.string(),
+    "GLAZED_TYPE": CATEGORY,
+    "GLAZED_AREA": CATEGORY,
     "EXTENSION_COUNT": pyarrow.float64(),  # int but values are floats, e.g 1.0
     "NUMBER_HABITABLE_ROOMS": pyarrow.float64(),  # int but values are floats, e.g 1.0
     "NUMBER_HEATED_ROOMS": pyarrow.float64(),
     "LOW_ENERGY_LIGHTING": pyarrow.int64(),
     "NUMBER_OPEN_FIREPLACES": pyarrow.int64(),
     "HOTWATER_DESCRIPTION": pyarrow.string(),
-    "HOT_WATER_ENERGY_EFF": pyarrow.string(),
-    "HOT_WATER_ENV_EFF": pyarrow.string(),
+    "HOT_WATER_ENERGY_EFF": CATEGORY,
+    "HOT_WATER_ENV_EFF": CATEGORY,
     "FLOOR_DESCRIPTION": pyarrow.string(),
-    "FLOOR_ENERGY_EFF": pyarrow.string(),
-    "FLOOR_ENV_EFF": pyarrow.string(),
+    "FLOOR_ENERGY_EFF": CATEGORY,
+    "FLOOR_ENV_EFF": CATEGORY,
     "WINDOWS_DESCRIPTION": pyarrow.string(),
-    "WINDOWS_ENERGY_EFF": pyarrow.string(),
-    "WINDOWS_ENV_EFF": pyarrow.string(),
+    "WINDOWS_ENERGY_EFF": CATEGORY,
+    "WINDOWS_ENV_EFF": CATEGORY,
     "WALLS_DESCRIPTION": pyarrow.string(),
-    "WALLS_ENERGY_EFF": pyarrow.string(),
-    "WALLS_ENV_EFF": pyarrow.string(),
+    "WALLS_ENERGY_EFF": CATEGORY,
+    "WALLS_ENV_EFF": CATEGORY,
     "SECONDHEAT_DESCRIPTION": pyarrow.string(),
-    "SHEATING_ENERGY_EFF": pyarrow.string(),
-    "SHEATING_ENV_EFF": pyarrow.string(),
+    "SHEATING_ENERGY_EFF": CATEGORY,
+    "SHEATING_ENV_EFF": CATEGORY,
     "ROOF_DESCRIPTION": pyarrow.string(),
-    "ROOF_ENERGY_EFF": pyarrow.string(),
-    "ROOF_ENV_EFF": pyarrow.string(),
+    "ROOF_ENERGY_EFF": CATEGORY,
+    "ROOF_ENV_EFF": CATEGORY,
     "MAINHEAT_DESCRIPTION": pyarrow.string(),
-    "MAINHEAT_ENERGY_EFF": pyarrow.string(),
-    "MAINHEAT_ENV_EFF": pyarrow.string(),
+    "MAINHEAT_ENERGY_EFF": CATEGORY,
+    "MAINHEAT_ENV_EFF": CATEGORY,
     "MAINHEATCONT_DESCRIPTION": pyarrow.string(),
-    "MAINHEATC_ENERGY_EFF": pyarrow.string(),
-    "MAINHEATC_ENV_EFF": pyarrow.string(),
+    "MAINHEATC_ENERGY_EFF": CATEGORY,
+    "MAINHEATC_ENV_EFF": CATEGORY,
     "LIGHTING_DESCRIPTION": pyarrow.string(),
-    "LIGHTING_ENERGY_EFF": pyarrow.string(),
-    "LIGHTING_ENV_EFF": pyarrow.string(),
+    "LIGHTING_ENERGY_EFF": CATEGORY,
+    "LIGHTING_ENV_EFF": CATEGORY,
     "MAIN_FUEL": pyarrow.string(),
     "WIND_TURBINE_COUNT": pyarrow.float64(),
-    "HEAT_LOSS_CORRIDOR": pyarrow.string(),
+    "HEAT_LOSS_CORRIDOR": CATEGORY,
     "UNHEATED_CORRIDOR_LENGTH": pyarrow.float64(),
     "FLOOR_HEIGHT": pyarrow.float64(),
     "PHOTO_SUPPLY": pyarrow.float64(),
-    "SOLAR_WATER_HEATING_FLAG": pyarrow.string(),
-    "MECHANICAL_VENTILATION": pyarrow.string(),
+    "SOLAR_WATER_HEATING_FLAG": CATEGORY,
+    "MECHANICAL_VENTILATION": CATEGORY,
     "ADDRESS": pyarrow.string(),
-    "LOCAL_AUTHORITY_LABEL": pyarrow.string(),
-    "CONSTITUENCY_LABEL": pyarrow.string(),
+    "LOCAL_AUTHORITY_LABEL": CATEGORY,
+    "CONSTITUENCY_LABEL": CATEGORY,
     "POSTTOWN": pyarrow.string(),
-    "CONSTRUCTION_AGE_BAND": pyarrow.string(),
+    "CONSTRUCTION_AGE_BAND": CATEGORY,
     "LODGEMENT_DATETIME": pyarrow.timestamp("s"),
-    "TENURE": pyarrow.string(),
+    "TENURE": CATEGORY,
     "FIXED_LIGHTING_OUTLETS_COUNT": pyarrow.float64(),
     "LOW_ENERGY_FIXED_LIGHT_COUNT": pyarrow.float64(),
     "UPRN": pyarrow.int64(),
-    "UPRN_SOURCE": pyarrow.string(),
+    "UPRN_SOURCE": CATEGORY,
 }
 
 
@@ -117,60 +140,2241 @@ RECOMMENDATIONS_SCHEMA = {
 }
 
 
+def list_members(zip_file, pattern):
+    return [
+        member
+        for member in zip_file.infolist()
+        if fnmatch.fnmatch(member.filename, pattern)
+    ]
+
+
 def open_files(epc_zipfile, pattern):
     with zipfile.ZipFile(epc_zipfile, "r") as zip_file:
-        matching_files = [
-            member
-            for member in zip_file.infolist()
-            if fnmatch.fnmatch(member.filename, pattern)
-        ]
+        matching_files = list_members(zip_file, pattern)
 
         for matching_file in matching_files:
             yield zip_file.open(matching_file)
 
 
-def csv_to_parquet(csv_file, parquet_file, column_types=None):
-    table = pyarrow.csv.read_csv(
+# Without a block_size the whole CSV is read into one table. With one, the CSV
+# is streamed in blocks of roughly block_size bytes, so peak memory tracks the
+# block size rather than the size of the file.
+#
+# With project_to_schema, only the columns in column_types are converted, the
+# rest are skipped without being parsed, and any it lacks are filled with nulls.
+def read_csv_batches(
+    csv_file, column_types=None, block_size=None, project_to_schema=False
+):
+    convert_options = pyarrow.csv.ConvertOptions(
+        column_types=column_types or {},
+        include_columns=list(column_types or {}) if project_to_schema else None,
+        include_missing_columns=project_to_schema,
+    )
+    if block_size is None:
+        table = pyarrow.csv.read_csv(csv_file, convert_options=convert_options)
+        return table.schema, [table]
+
+    reader = pyarrow.csv.open_csv(
         csv_file,
-        convert_options=pyarrow.csv.ConvertOptions(column_types=column_types or {}),
+        read_options=pyarrow.csv.ReadOptions(block_size=block_size),
+        convert_options=convert_options,
+    )
+    return reader.schema, reader
+
+
+# A dataset with a _metadata file is opened from it alone, without reading
+# every part's footer. Otherwise, since parts converted with narrow_types can
+# keep a wider type for some columns, the schema is the one unified over every
+# part, which write_metadata_files still writes to _common_metadata when it
+# skips _metadata. Only a dataset with neither has every part's footer read to
+# unify it, rather than taking the schema from the first one.
+def open_dataset(dataset_path):
+    metadata_path = os.path.join(dataset_path, METADATA_FILE_NAME)
+    if os.path.exists(metadata_path):
+        return pyarrow.dataset.parquet_dataset(metadata_path)
+    common_metadata_path = os.path.join(dataset_path, COMMON_METADATA_FILE_NAME)
+    if os.path.exists(common_metadata_path):
+        schema = pyarrow.parquet.read_schema(common_metadata_path)
+        return pyarrow.dataset.dataset(dataset_path, schema=schema, format="parquet")
+    dataset = pyarrow.dataset.dataset(dataset_path, format="parquet")
+    schema = pyarrow.unify_schemas(
+        [fragment.physical_schema for fragment in dataset.get_fragments()]
+        or [dataset.schema],
+        promote_options="permissive",
+    )
+    return pyarrow.dataset.dataset(dataset_path, schema=schema, format="parquet")
+
+
+# Compute kernels compare dictionary arrays by index, and each batch has its own
+# dictionary, so they are compared by value instead.
+def decode(values):
+    if pyarrow.types.is_dictionary(values.type):
+        return values.cast(values.type.value_type)
+    return values
+
+
+# Writes the distinct LMK_KEYs of a certificates dataset, sorted, to an
+# uncompressed Arrow IPC file. It is built once per run and every worker memory
+# maps it, so the keys are held once rather than once per worker.
+def write_known_keys(dataset_path, lookup_path):
+    keys = open_dataset(dataset_path).to_table(columns=["LMK_KEY"])["LMK_KEY"]
+    keys = pyarrow.compute.drop_null(
+        pyarrow.compute.unique(decode(keys).combine_chunks())
+    )
+    keys = pyarrow.table({"LMK_KEY": keys.take(pyarrow.compute.sort_indices(keys))})
+    with pyarrow.ipc.new_file(lookup_path, keys.schema) as writer:
+        writer.write_table(keys, max_chunksize=max(keys.num_rows, 1))
+
+
+# Cached on the lookup's modification time, like open_key_index.
+@functools.lru_cache(maxsize=1)
+def open_known_keys(lookup_path, modified):
+    reader = pyarrow.ipc.open_file(pyarrow.memory_map(lookup_path))
+    if not reader.num_record_batches:
+        return pyarrow.array([], pyarrow.string())
+    return reader.get_batch(0)["LMK_KEY"]
+
+
+# Binary searches the sorted keys for every key in the batch at once, so each
+# batch costs O(rows * log(keys)) and nothing is rebuilt from the keys. A key
+# is known when the key at the position it would be inserted at equals it.
+def drop_known_keys(batch, known_keys):
+    if not len(known_keys):
+        return batch
+    keys = decode(batch["LMK_KEY"])
+    positions = pyarrow.compute.min_element_wise(
+        pyarrow.compute.search_sorted(known_keys, keys).cast(pyarrow.int64()),
+        len(known_keys) - 1,
+    )
+    known = pyarrow.compute.equal(known_keys.take(positions), keys)
+    return batch.filter(pyarrow.compute.invert(pyarrow.compute.fill_null(known, False)))
+
+
+def sort_table(table, sort_keys):
+    keys = pyarrow.table({column: decode(table[column]) for column, _ in sort_keys})
+    return table.take(pyarrow.compute.sort_indices(keys, sort_keys=sort_keys))
+
+
+# Regroups batches, or tables, into tables of rows rows, the last of which may
+# be shorter, so each can be written as one row group however small the
+# batches it came from were. With max_bytes, a table is also cut short once it
+# holds about that many bytes of Arrow data, estimated from the average row size
+# of each batch.
+def rebatch(batches, rows, max_bytes=None):
+    pending = []
+    pending_rows = 0
+    pending_bytes = 0
+    for batch in batches:
+        row_bytes = batch.nbytes / max(batch.num_rows, 1)
+        while batch.num_rows:
+            taken = min(rows - pending_rows, batch.num_rows)
+            if max_bytes is not None:
+                taken = min(
+                    taken, max(math.ceil((max_bytes - pending_bytes) / row_bytes), 1)
+                )
+            pending.append(pyarrow.table(batch.slice(0, taken)))
+            pending_rows += taken
+            pending_bytes += taken * row_bytes
+            batch = batch.slice(taken)
+            if pending_rows == rows or (
+                max_bytes is not None and pending_bytes >= max_bytes
+            ):
+                yield pyarrow.concat_tables(pending)
+                pending = []
+                pending_rows = 0
+                pending_bytes = 0
+    if pending:
+        yield pyarrow.concat_tables(pending)
+
+
+SORT_MAX_BUCKETS = 64
+SORT_BUCKET_BYTES = 256 * 1024**2
+SORT_SAMPLE_ROWS = 1024
+
+
+# An external sort for batches too large to sort in memory together. Batches are
+# spilled to disk while sampling the first sort column and counting their size.
+# There are as many buckets as it takes to keep each to about bucket_bytes of
+# Arrow data, so a part that fits in one is sorted in memory whole. Otherwise,
+# the sample's quantiles split the rows into buckets of roughly equal size, and
+# each bucket is then sorted in memory and yielded in order.
+def sort_batches_externally(
+    schema, batches, sort_keys, spill_path, bucket_bytes=SORT_BUCKET_BYTES
+):
+    sort_column = sort_keys[0][0]
+    unsorted_path = os.path.join(spill_path, "unsorted.arrow")
+    samples = []
+    size = 0
+    # Streams rather than files, since each batch has its own dictionaries.
+    with pyarrow.ipc.new_stream(unsorted_path, schema) as writer:
+        for batch in batches:
+            writer.write(batch)
+            size += batch.nbytes
+            step = max(batch.num_rows // SORT_SAMPLE_ROWS, 1)
+            samples.append(decode(batch[sort_column][::step]))
+
+    bucket_count = min(max(-(-size // bucket_bytes), 1), SORT_MAX_BUCKETS)
+    if bucket_count == 1:
+        with pyarrow.memory_map(unsorted_path) as source:
+            yield sort_table(pyarrow.ipc.open_stream(source).read_all(), sort_keys)
+        os.remove(unsorted_path)
+        return
+
+    sample = pyarrow.compute.drop_null(
+        pyarrow.concat_arrays(
+            samples or [decode(pyarrow.array([], schema.field(sort_column).type))]
+        )
+    )
+    sample = sample.take(pyarrow.compute.sort_indices(sample))
+    quantiles = [
+        len(sample) * bucket // bucket_count for bucket in range(1, bucket_count)
+    ]
+    boundaries = pyarrow.compute.unique(sample.take(quantiles if len(sample) else []))
+
+    bucket_writers = {}
+    with pyarrow.memory_map(unsorted_path) as source:
+        for batch in pyarrow.ipc.open_stream(source):
+            # Nulls sort last, so they go in the last bucket.
+            buckets = pyarrow.repeat(0, batch.num_rows)
+            for boundary in boundaries:
+                at_or_above = pyarrow.compute.fill_null(
+                    pyarrow.compute.greater_equal(decode(batch[sort_column]), boundary),
+                    True,
+                )
+                buckets = pyarrow.compute.add(
+                    buckets, pyarrow.compute.cast(at_or_above, pyarrow.int64())
+                )
+            for bucket in pyarrow.compute.unique(buckets).to_pylist():
+                if bucket not in bucket_writers:
+                    bucket_writers[bucket] = pyarrow.ipc.new_stream(
+                        os.path.join(spill_path, f"bucket-{bucket:03}.arrow"), schema
+                    )
+                bucket_writers[bucket].write(
+                    batch.filter(pyarrow.compute.equal(buckets, bucket))
+                )
+    for writer in bucket_writers.values():
+        writer.close()
+    os.remove(unsorted_path)
+
+    for bucket in sorted(bucket_writers):
+        bucket_path = os.path.join(spill_path, f"bucket-{bucket:03}.arrow")
+        with pyarrow.memory_map(bucket_path) as source:
+            yield sort_table(pyarrow.ipc.open_stream(source).read_all(), sort_keys)
+        os.remove(bucket_path)
+
+
+# Returns ParquetWriter compression arguments applying compression and
+# compression_level to every column, except those matching a pattern in
+# column_compression, which maps glob patterns to (codec, level) pairs.
+def compression_options(schema, compression, compression_level, column_compression):
+    codecs = {name: compression for name in schema.names}
+    levels = {name: compression_level for name in schema.names}
+    for pattern, (codec, level) in (column_compression or {}).items():
+        for name in fnmatch.filter(schema.names, pattern):
+            codecs[name] = codec
+            levels[name] = level
+    levels = {name: level for name, level in levels.items() if level is not None}
+    return {"compression": codecs, "compression_level": levels or None}
+
+
+# Narrower types for columns whose values are small, or whole numbers stored as
+# floats, used when converting with narrow_types. Each is only applied to a file
+# if every value in the file fits, which for float32 means it converts back to
+# exactly the same float64. Columns holding decimals, like costs, floor areas
+# and CO2 emissions, are left out, since hardly any decimal survives float32.
+NARROW_TYPES = {
+    "CURRENT_ENERGY_EFFICIENCY": pyarrow.int16(),
+    "POTENTIAL_ENERGY_EFFICIENCY": pyarrow.int16(),
+    "ENVIRONMENT_IMPACT_CURRENT": pyarrow.float32(),
+    "ENVIRONMENT_IMPACT_POTENTIAL": pyarrow.float32(),
+    "ENERGY_CONSUMPTION_CURRENT": pyarrow.float32(),
+    "ENERGY_CONSUMPTION_POTENTIAL": pyarrow.float32(),
+    "FLAT_STOREY_COUNT": pyarrow.int8(),
+    "MULTI_GLAZE_PROPORTION": pyarrow.int16(),
+    "EXTENSION_COUNT": pyarrow.int8(),
+    "NUMBER_HABITABLE_ROOMS": pyarrow.int16(),
+    "NUMBER_HEATED_ROOMS": pyarrow.int16(),
+    "LOW_ENERGY_LIGHTING": pyarrow.int16(),
+    "NUMBER_OPEN_FIREPLACES": pyarrow.int8(),
+    "WIND_TURBINE_COUNT": pyarrow.int8(),
+    "PHOTO_SUPPLY": pyarrow.float32(),
+    "FIXED_LIGHTING_OUTLETS_COUNT": pyarrow.int16(),
+    "LOW_ENERGY_FIXED_LIGHT_COUNT": pyarrow.int16(),
+    "IMPROVEMENT_ITEM": pyarrow.int16(),
+    "IMPROVEMENT_ID": pyarrow.int16(),
+}
+
+
+class NarrowTypeOverflow(ValueError):
+    def __init__(self, columns):
+        super().__init__(f"{', '.join(columns)} do not fit their narrow types")
+        self.columns = columns
+
+
+# Casts columns to the narrower types in schema, returning the batch and the
+# names of the columns with values that don't fit. Safe casts already reject
+# integers out of range and floats with a fractional part, but float64 to
+# float32 rounds, or overflows to infinity, without complaint. So floats are
+# only narrowed when every value survives the round trip back to float64.
+def narrow_batch(batch, schema):
+    columns, overflows = [], []
+    for field, column in zip(schema, batch.columns):
+        if column.type != field.type:
+            try:
+                narrowed = column.cast(field.type)
+            except pyarrow.ArrowInvalid:
+                overflows.append(field.name)
+                continue
+            if pyarrow.types.is_floating(field.type):
+                round_trip = narrowed.cast(column.type)
+                unchanged = pyarrow.compute.or_(
+                    pyarrow.compute.equal(round_trip, column),
+                    pyarrow.compute.and_(
+                        pyarrow.compute.is_nan(round_trip),
+                        pyarrow.compute.is_nan(column),
+                    ),
+                )
+                if not pyarrow.compute.all(unchanged).as_py():
+                    overflows.append(field.name)
+                    continue
+            column = narrowed
+        columns.append(column)
+    if overflows:
+        return None, overflows
+    return type(batch).from_arrays(columns, schema=schema), overflows
+
+
+# Once a batch has a column that doesn't fit, the rest are only checked, so the
+# NarrowTypeOverflow names every such column in the file and it takes at most
+# one more attempt to convert it.
+def narrow_batches(schema, batches, narrow_types):
+    schema = pyarrow.schema(
+        [field.with_type(narrow_types.get(field.name, field.type)) for field in schema],
+        schema.metadata,
+    )
+
+    def narrowed():
+        overflows = set()
+        for batch in batches:
+            batch, batch_overflows = narrow_batch(batch, schema)
+            overflows.update(batch_overflows)
+            if not overflows:
+                yield batch
+        if overflows:
+            raise NarrowTypeOverflow(sorted(overflows))
+
+    return schema, narrowed()
+
+
+# Groups recommendations into one row per LMK_KEY, with a RECOMMENDATIONS list
+# of the remaining columns as structs, in IMPROVEMENT_ITEM order. The rows are
+# in LMK_KEY order and in one batch, so they can be binary searched.
+def nest_recommendations(recommendations):
+    recommendations = recommendations.filter(
+        pyarrow.compute.is_valid(recommendations["LMK_KEY"])
+    )
+    sort_keys = [
+        (column, "ascending")
+        for column in ["LMK_KEY", "IMPROVEMENT_ITEM"]
+        if column in recommendations.column_names
+    ]
+    recommendations = recommendations.sort_by(sort_keys)
+    keys = recommendations["LMK_KEY"].combine_chunks()
+    fields = [name for name in recommendations.column_names if name != "LMK_KEY"]
+    items = pyarrow.StructArray.from_arrays(
+        [recommendations[name].combine_chunks() for name in fields], fields
+    )
+    # Each LMK_KEY's recommendations start where the key differs from the
+    # previous row's.
+    starts = pyarrow.compute.indices_nonzero(
+        pyarrow.concat_arrays(
+            [
+                pyarrow.array([len(keys) > 0]),
+                pyarrow.compute.not_equal(keys[1:], keys[:-1]),
+            ]
+        )
+    ).cast(pyarrow.int32())
+    offsets = pyarrow.concat_arrays(
+        [starts, pyarrow.array([recommendations.num_rows], pyarrow.int32())]
+    )
+    return pyarrow.record_batch(
+        {
+            "LMK_KEY": keys.take(starts),
+            "RECOMMENDATIONS": pyarrow.ListArray.from_arrays(offsets, items),
+        }
+    )
+
+
+# The recommendations.csv in the same folder as a certificates.csv holds the
+# recommendations for those certificates. Certificates without any, including
+# every certificate in a folder without one, get a null list.
+def recommendations_member(zip_file, certificates_member):
+    member_name = posixpath.join(
+        posixpath.dirname(certificates_member.filename), "recommendations.csv"
+    )
+    try:
+        return zip_file.getinfo(member_name)
+    except KeyError:
+        return None
+
+
+# Every recommendation of a member is held in memory, nested, while its
+# certificates are converted. With a block_size the CSV is streamed, so at least
+# its text isn't held too.
+def read_nested_recommendations(zip_file, member, block_size=None):
+    if member is None:
+        schema = pyarrow.schema(list(RECOMMENDATIONS_SCHEMA.items()))
+        return nest_recommendations(schema.empty_table())
+    with zip_file.open(member) as csv_file:
+        schema, batches = read_csv_batches(csv_file, RECOMMENDATIONS_SCHEMA, block_size)
+        table = pyarrow.concat_tables(
+            [schema.empty_table(), *(pyarrow.table(batch) for batch in batches)]
+        )
+    return nest_recommendations(table)
+
+
+# Joins a batch of certificates with the recommendations of their member. Like
+# drop_known_keys, it binary searches their sorted keys, so nothing is rebuilt
+# per batch. A certificate without recommendations gets a null list rather than
+# an empty one.
+def attach_recommendations(batch, recommendations):
+    nested_keys = recommendations["LMK_KEY"]
+    nested = recommendations["RECOMMENDATIONS"]
+    if not len(nested_keys):
+        return batch.append_column(
+            "RECOMMENDATIONS", pyarrow.nulls(batch.num_rows, nested.type)
+        )
+    keys = decode(batch["LMK_KEY"])
+    positions = pyarrow.compute.min_element_wise(
+        pyarrow.compute.search_sorted(nested_keys, keys).cast(pyarrow.int64()),
+        len(nested_keys) - 1,
+    )
+    found = pyarrow.compute.fill_null(
+        pyarrow.compute.equal(nested_keys.take(positions), keys), False
+    )
+    return batch.append_column(
+        "RECOMMENDATIONS",
+        nested.take(pyarrow.compute.if_else(found, positions, None)),
+    )
+
+
+# With narrow_types, columns are stored with the narrower types it gives them.
+# When values in the file do not fit, the file is converted again with those
+# columns' types left as they are. csv_file can be a path, or a function that
+# opens the CSV, which is called again for each attempt: seeking a file back
+# while the last attempt's reader may still be reading ahead corrupts it.
+def csv_to_parquet(
+    csv_file, parquet_file, column_types=None, narrow_types=None, **options
+):
+    narrow_types = dict(narrow_types or {})
+    while True:
+        try:
+            with contextlib.ExitStack() as stack:
+                source = csv_file
+                if callable(csv_file):
+                    source = stack.enter_context(csv_file())
+                return write_parquet(
+                    source, parquet_file, column_types, narrow_types, **options
+                )
+        except NarrowTypeOverflow as overflow:
+            for column in overflow.columns:
+                del narrow_types[column]
+
+
+# High cardinality columns that certificates are looked up by
+BLOOM_FILTER_COLUMNS = ["LMK_KEY", "UPRN", "POSTCODE", "BUILDING_REFERENCE_NUMBER"]
+
+
+# Returns writer bloom_filter_options for the columns of schema in
+# bloom_filter_columns, sized for row groups of up to rows_per_group rows.
+def bloom_filter_options(
+    schema, bloom_filter_columns, bloom_filter_fpp, rows_per_group
+):
+    return {
+        column: {"fpp": bloom_filter_fpp, "ndv": max(rows_per_group or 1024**2, 1)}
+        for column in bloom_filter_columns or []
+        if column in schema.names
+    } or None
+
+
+# Streamed batches, which are as small as the block_size, are regrouped into
+# row groups of row_group_size rows, or without one into row groups of this many
+# rows or bytes of Arrow data, whichever is reached first, since a row group per
+# block bloats the file with a footer entry, statistics and a dictionary page per
+# column for every block. The row group being buffered, rather than the block,
+# is what dominates peak memory: 65,536 rows of certificates are about 90 MB, so
+# the byte budget is what bounds wide files, and the row count narrow ones.
+STREAMED_ROW_GROUP_SIZE = 64 * 1024
+STREAMED_ROW_GROUP_BYTES = 32 * 1024**2
+
+
+# With known_keys, a lookup written by write_known_keys from a certificates
+# dataset, rows whose LMK_KEY is in that dataset are dropped as each batch is
+# read, so only certificates (or recommendations for certificates) that are new
+# since it was produced are written. Likewise, only rows matching a row_filter
+# expression are kept.
+#
+# With recommendations, from nest_recommendations, each certificate gets its
+# recommendations as a RECOMMENDATIONS list column.
+#
+# With bloom_filter_columns, each row group gets a bloom filter with a false
+# positive rate of bloom_filter_fpp on those columns, for find_rows.
+#
+# With page_index, each column chunk gets a column index, of the min/max of its
+# pages, and an offset index, of where they start, which find_rows also uses.
+# data_page_size sets the size of those pages in bytes.
+#
+# With sort_by, rows are sorted on those columns before they are written, which
+# keeps the row group statistics on them narrow. A whole table is sorted in
+# memory; streamed batches are sorted externally, spilling next to parquet_file.
+def write_parquet(
+    csv_file,
+    parquet_file,
+    column_types=None,
+    narrow_types=None,
+    block_size=None,
+    known_keys=None,
+    sort_by=None,
+    row_group_size=None,
+    compression="snappy",
+    compression_level=None,
+    column_compression=None,
+    project_to_schema=False,
+    row_filter=None,
+    recommendations=None,
+    bloom_filter_columns=None,
+    bloom_filter_fpp=0.05,
+    page_index=False,
+    data_page_size=None,
+):
+    schema, batches = read_csv_batches(
+        csv_file, column_types, block_size, project_to_schema
     )
-    pyarrow.parquet.write_table(table, parquet_file)
-    return None
+    if known_keys is not None:
+        keys = open_known_keys(known_keys, os.path.getmtime(known_keys))
+        batches = (drop_known_keys(batch, keys) for batch in batches)
+    if row_filter is not None:
+        batches = (batch.filter(row_filter) for batch in batches)
+    if narrow_types:
+        schema, batches = narrow_batches(schema, batches, narrow_types)
+    if recommendations is not None:
+        schema = schema.append(recommendations.schema.field("RECOMMENDATIONS"))
+        batches = (attach_recommendations(batch, recommendations) for batch in batches)
+
+    # The same sort_by applies to every dataset, so columns a file lacks (like
+    # POSTCODE in recommendations) are skipped.
+    sort_keys = [
+        (column, "ascending") for column in sort_by or [] if column in schema.names
+    ]
+    sorting_columns = None
+    with contextlib.ExitStack() as stack:
+        if sort_keys:
+            sorting_columns = pyarrow.parquet.SortingColumn.from_ordering(
+                schema, sort_keys
+            )
+            if block_size is None:
+                batches = [sort_table(table, sort_keys) for table in batches]
+            else:
+                spill_path = stack.enter_context(
+                    tempfile.TemporaryDirectory(
+                        prefix=".sort-",
+                        dir=os.path.dirname(os.path.abspath(parquet_file)),
+                    )
+                )
+                batches = sort_batches_externally(
+                    schema, batches, sort_keys, spill_path
+                )
+        # Filters are sized for the rows in a row group: at most the rows
+        # streamed batches are regrouped into, or a whole table, unless
+        # row_group_size splits it. The whole table is read first to count
+        # them, even when filters or narrowing wrap it.
+        if block_size is not None:
+            if row_group_size is None:
+                rows_per_group = STREAMED_ROW_GROUP_SIZE
+                batches = rebatch(
+                    batches, rows_per_group, max_bytes=STREAMED_ROW_GROUP_BYTES
+                )
+            else:
+                rows_per_group = row_group_size
+                batches = rebatch(batches, rows_per_group)
+        else:
+            batches = list(batches)
+            rows_per_group = row_group_size or max(
+                (table.num_rows for table in batches), default=None
+            )
+
+        metadata_collector = []
+        with pyarrow.parquet.ParquetWriter(
+            parquet_file,
+            schema,
+            sorting_columns=sorting_columns,
+            metadata_collector=metadata_collector,
+            bloom_filter_options=bloom_filter_options(
+                schema, bloom_filter_columns, bloom_filter_fpp, rows_per_group
+            ),
+            write_page_index=page_index,
+            data_page_size=data_page_size,
+            **compression_options(
+                schema, compression, compression_level, column_compression
+            ),
+        ) as writer:
+            for batch in batches:
+                writer.write(batch, row_group_size=row_group_size)
+    return metadata_collector[0]
+
+
+# Parses PATTERN=CODEC[:LEVEL], e.g. *_DESCRIPTION=zstd:9
+def column_compression(value):
+    pattern, _, codec = value.partition("=")
+    codec, _, level = codec.partition(":")
+    if not pattern or not codec:
+        raise ValueError(value)
+    return pattern, (codec, int(level) if level else None)
+
+
+ROW_FILTER_NAMES = {
+    "field": pyarrow.compute.field,
+    "scalar": pyarrow.compute.scalar,
+    "date": datetime.date,
+    "datetime": datetime.datetime,
+}
+ROW_FILTER_METHODS = {"isin", "is_null", "is_valid", "is_nan", "cast"}
+ROW_FILTER_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.BitAnd: operator.and_,
+    ast.BitOr: operator.or_,
+    ast.And: operator.and_,
+    ast.Or: operator.or_,
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Not: operator.invert,
+    ast.Invert: operator.invert,
+    ast.USub: operator.neg,
+}
+
+
+# Builds a filter from the syntax tree of one, allowing only constants, lists
+# of them, comparisons and boolean operators, and calls of the names above,
+# compute functions as pc.<function> and a few Expression methods. Anything
+# else, such as other names or attributes, is rejected rather than evaluated.
+def build_row_filter(node):
+    if isinstance(node, ast.Constant) and isinstance(
+        node.value, (str, int, float, bool, type(None))
+    ):
+        return node.value
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [build_row_filter(element) for element in node.elts]
+    if isinstance(node, ast.Name) and node.id in ROW_FILTER_NAMES:
+        return ROW_FILTER_NAMES[node.id]
+    if isinstance(node, ast.Attribute):
+        if isinstance(node.value, ast.Name) and node.value.id == "pc":
+            if node.attr in ROW_FILTER_NAMES:
+                return ROW_FILTER_NAMES[node.attr]
+            if node.attr in pyarrow.compute.list_functions():
+                return getattr(pyarrow.compute, node.attr)
+        elif node.attr in ROW_FILTER_METHODS:
+            value = build_row_filter(node.value)
+            if isinstance(value, pyarrow.compute.Expression):
+                return getattr(value, node.attr)
+    if isinstance(node, ast.Call) and all(keyword.arg for keyword in node.keywords):
+        return build_row_filter(node.func)(
+            *[build_row_filter(argument) for argument in node.args],
+            **{
+                keyword.arg: build_row_filter(keyword.value)
+                for keyword in node.keywords
+            },
+        )
+    if isinstance(node, ast.UnaryOp) and type(node.op) in ROW_FILTER_OPERATORS:
+        return ROW_FILTER_OPERATORS[type(node.op)](build_row_filter(node.operand))
+    if isinstance(node, ast.BinOp) and type(node.op) in ROW_FILTER_OPERATORS:
+        return ROW_FILTER_OPERATORS[type(node.op)](
+            build_row_filter(node.left), build_row_filter(node.right)
+        )
+    if isinstance(node, ast.BoolOp):
+        return functools.reduce(
+            ROW_FILTER_OPERATORS[type(node.op)], map(build_row_filter, node.values)
+        )
+    if isinstance(node, ast.Compare) and all(
+        type(op) in ROW_FILTER_OPERATORS for op in node.ops
+    ):
+        operands = [
+            build_row_filter(node.left),
+            *map(build_row_filter, node.comparators),
+        ]
+        return functools.reduce(
+            operator.and_,
+            [
+                ROW_FILTER_OPERATORS[type(op)](left, right)
+                for op, left, right in zip(node.ops, operands, operands[1:])
+            ],
+        )
+    raise ValueError(f"not allowed in a filter: {ast.unparse(node)}")
+
+
+# Parses a filter written in Python using pyarrow.compute expressions, e.g.
+# field("LODGEMENT_DATE") >= date(2015, 1, 1). It is built by build_row_filter
+# rather than evaluated, so it can't run arbitrary code.
+def row_filter(value):
+    try:
+        expression = build_row_filter(ast.parse(value, mode="eval").body)
+    except SyntaxError:
+        raise ValueError(value)
+    if not isinstance(expression, pyarrow.compute.Expression):
+        raise ValueError(value)
+    return expression
 
 
 def parse_args(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("epc_zipfile")
     parser.add_argument("output_path")
-    return parser.parse_args(args)
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        help="stream each CSV in blocks of this many bytes to bound memory use",
+    )
+    parser.add_argument(
+        "--sort-by",
+        type=lambda columns: columns.split(","),
+        help="comma separated columns to sort each part by, e.g. POSTCODE,UPRN",
+    )
+    parser.add_argument(
+        "--row-group-size",
+        type=int,
+        help="maximum number of rows in each Parquet row group",
+    )
+    parser.add_argument(
+        "--compression",
+        default="snappy",
+        help="Parquet compression codec, e.g. snappy, zstd, lz4, gzip or none",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        help="compression level for codecs that support one",
+    )
+    parser.add_argument(
+        "--column-compression",
+        type=column_compression,
+        action="append",
+        metavar="PATTERN=CODEC[:LEVEL]",
+        help="compression for the columns matching PATTERN, e.g. "
+        "'*_DESCRIPTION=zstd:9', may be given more than once",
+    )
+    parser.add_argument(
+        "--column-sizes",
+        action="store_true",
+        help="print the bytes written for each column after converting",
+    )
+    parser.add_argument(
+        "--columns",
+        type=lambda columns: columns.split(","),
+        help="comma separated certificate columns to convert, LMK_KEY is always "
+        "included",
+    )
+    parser.add_argument(
+        "--filter",
+        type=row_filter,
+        help="only write certificates matching this pyarrow.compute expression, "
+        "e.g. 'field(\"LODGEMENT_DATE\") >= date(2015, 1, 1)'",
+    )
+    parser.add_argument(
+        "--bloom-filters",
+        nargs="?",
+        const=BLOOM_FILTER_COLUMNS,
+        type=lambda columns: columns.split(","),
+        help="write bloom filters for these comma separated columns, by default "
+        + ",".join(BLOOM_FILTER_COLUMNS),
+    )
+    parser.add_argument(
+        "--bloom-filter-fpp",
+        type=float,
+        default=0.05,
+        help="false positive rate of the bloom filters",
+    )
+    parser.add_argument(
+        "--page-index",
+        action="store_true",
+        help="write the Parquet page index, of min/max statistics for every page",
+    )
+    parser.add_argument(
+        "--data-page-size",
+        type=int,
+        help="target size of each data page in bytes",
+    )
+    parser.add_argument(
+        "--key-index",
+        action="store_true",
+        help="write an LMK_KEY index next to each dataset, for get_certificate",
+    )
+    parser.add_argument(
+        "--nest-recommendations",
+        action="store_true",
+        help="also store each certificate's recommendations in a RECOMMENDATIONS "
+        "list column",
+    )
+    parser.add_argument(
+        "--narrow-types",
+        action="store_true",
+        help="store small numeric columns as int8/int16/float32 where they fit",
+    )
+    parser.add_argument(
+        "--partition-by",
+        choices=["local-authority", *LODGEMENT_DATE_PARTITIONS],
+        help="write parts into hive partition directories",
+    )
+    parser.add_argument(
+        "--max-open-files",
+        type=int,
+        default=64,
+        help="most files open at once when partitioning by lodgement date",
+    )
+    parser.add_argument(
+        "--compact-target-size",
+        type=int,
+        help="after converting, compact parts into files of about this many MB",
+    )
+    parser.add_argument(
+        "--previous-certificates",
+        help="only write certificates, and their recommendations, whose LMK_KEY "
+        "is not in this previously converted certificates dataset",
+    )
+    parser.add_argument(
+        "--diff-against",
+        help="after converting, write the LMK_KEYs inserted, updated and deleted "
+        "since this previously converted certificates dataset to "
+        "OUTPUT_PATH/changes",
+    )
+    parser.add_argument(
+        "--latest",
+        action="store_true",
+        help="after converting, write the latest certificate for each property "
+        "to OUTPUT_PATH/latest",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="reuse Parquet converted from identical zip members by earlier runs",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip members already converted by a previous run",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes converting zip members concurrently",
+    )
+    parsed_args = parser.parse_args(args)
+    unknown_columns = set(parsed_args.columns or []) - set(CERTIFICATE_SCHEMA)
+    if unknown_columns:
+        parser.error(f"unknown columns: {', '.join(sorted(unknown_columns))}")
+    if (
+        parsed_args.columns
+        and parsed_args.partition_by in LODGEMENT_DATE_PARTITIONS
+        and "LODGEMENT_DATE" not in parsed_args.columns
+    ):
+        parser.error("--partition-by lodgement-* needs LODGEMENT_DATE in --columns")
+    if parsed_args.columns and parsed_args.latest:
+        missing_columns = set(LATEST_CERTIFICATE_COLUMNS) - {
+            "LMK_KEY",
+            *parsed_args.columns,
+        }
+        if missing_columns:
+            parser.error(f"--latest needs {', '.join(sorted(missing_columns))}")
+    # Cached parts are keyed on the zip member, not on the previous dataset
+    if parsed_args.previous_certificates and parsed_args.cache_dir:
+        parser.error("--previous-certificates cannot be used with --cache-dir")
+    if parsed_args.key_index:
+        parsed_args.row_group_size = min(
+            parsed_args.row_group_size or KEY_INDEX_ROW_GROUP_SIZE,
+            KEY_INDEX_ROW_GROUP_SIZE,
+        )
+    return parsed_args
+
+
+MANIFEST_FILE_NAME = "_manifest.json"
+METADATA_FILE_NAME = "_metadata"
+COMMON_METADATA_FILE_NAME = "_common_metadata"
+
+
+def temporary_path(path):
+    directory, file_name = os.path.split(path)
+    # Hidden so dataset readers ignore it if a run dies before it is renamed
+    return os.path.join(directory, f".{file_name}.tmp")
+
+
+def read_manifest(output_path):
+    try:
+        with open(os.path.join(output_path, MANIFEST_FILE_NAME)) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(output_path, manifest):
+    manifest_path = os.path.join(output_path, MANIFEST_FILE_NAME)
+    with open(temporary_path(manifest_path), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(temporary_path(manifest_path), manifest_path)
+
+
+# Writes the schema of a dataset's parts to _common_metadata and, when every part
+# has the same schema, the footers of all of them, with each row group's path
+# relative to dataset_path, to _metadata. Readers can then plan a scan from
+# _metadata alone. file_metadata maps part paths to their FileMetaData.
+def write_metadata_files(dataset_path, file_metadata):
+    schemas = [metadata.schema.to_arrow_schema() for metadata in file_metadata.values()]
+    if not schemas:
+        return
+    schema = pyarrow.unify_schemas(schemas, promote_options="permissive")
+    common_metadata_path = os.path.join(dataset_path, COMMON_METADATA_FILE_NAME)
+    pyarrow.parquet.write_metadata(schema, temporary_path(common_metadata_path))
+    os.replace(temporary_path(common_metadata_path), common_metadata_path)
+
+    metadata_path = os.path.join(dataset_path, METADATA_FILE_NAME)
+    # Parts converted with narrow_types can have different schemas, which a
+    # single _metadata cannot describe.
+    if any(not other.equals(schemas[0]) for other in schemas):
+        print(f"Not writing {metadata_path}, the parts' schemas differ")
+        if os.path.exists(metadata_path):
+            os.remove(metadata_path)
+        return
+    metadata_collector = []
+    for path, metadata in sorted(file_metadata.items()):
+        relative_path = os.path.relpath(path, dataset_path).replace(os.sep, "/")
+        metadata.set_file_path(relative_path)
+        metadata_collector.append(metadata)
+    pyarrow.parquet.write_metadata(
+        schemas[0],
+        temporary_path(metadata_path),
+        metadata_collector=metadata_collector,
+    )
+    os.replace(temporary_path(metadata_path), metadata_path)
+    print(f"Written {metadata_path}")
+
+
+# A member is already converted if the manifest saw the same zip entry written
+# to the same part with the same schema and options, and that part is still
+# there at the size it was written. key is the member's conversion_key.
+def is_converted(manifest_entry, member, key, parquet_file_path, output_path):
+    return (
+        manifest_entry is not None
+        and manifest_entry.get("key") == key
+        and manifest_entry["crc32"] == member.CRC
+        and manifest_entry["file_size"] == member.file_size
+        and manifest_entry["path"] == os.path.relpath(parquet_file_path, output_path)
+        and os.path.exists(parquet_file_path)
+        and os.path.getsize(parquet_file_path) == manifest_entry["size"]
+    )
+
+
+# Bumped whenever a change to the converter changes the Parquet it writes for
+# the same member and options, so parts cached or converted before it aren't
+# reused.
+CONVERSION_VERSION = 1
+
+
+# Identifies the Parquet a member converts to: the zip entry's CRC32 and size
+# pin down its content, the schema and options how it was converted, and the
+# converter's and pyarrow's versions what wrote it.
+def cache_key(member, schema, options):
+    key = json.dumps(
+        {
+            "version": CONVERSION_VERSION,
+            "pyarrow": pyarrow.__version__,
+            "crc32": member.CRC,
+            "file_size": member.file_size,
+            "schema": {name: str(type_) for name, type_ in (schema or {}).items()},
+            "options": {name: repr(value) for name, value in options.items()},
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+# The cache_key of converting a member with options. Certificates with nested
+# recommendations also depend on the recommendations.csv in their folder.
+def conversion_key(zip_file, member, schema, options):
+    options = dict(options)
+    if options.pop("nest_recommendations", False):
+        nested_member = recommendations_member(zip_file, member)
+        options["recommendations"] = nested_member and (
+            nested_member.CRC,
+            nested_member.file_size,
+        )
+    return cache_key(member, schema, options)
+
+
+# May run in a worker process, so it opens its own handle on the zip rather
+# than sharing the parent's. The part is written under a temporary name and
+# renamed into place, so a part that exists was written completely.
+#
+# With a cache_dir, a part converted from an identical member by any earlier
+# run is copied from the cache instead of converting the member again.
+def convert_member(
+    epc_zipfile, member_name, parquet_file_path, schema, cache_dir=None, **options
+):
+    start = time.monotonic()
+    os.makedirs(os.path.dirname(parquet_file_path), exist_ok=True)
+    with zipfile.ZipFile(epc_zipfile, "r") as zip_file:
+        member = zip_file.getinfo(member_name)
+        cached_path = None
+        if cache_dir is not None:
+            key = conversion_key(zip_file, member, schema, options)
+            cached_path = os.path.join(cache_dir, f"{key}.parquet")
+
+        if cached_path is not None and os.path.exists(cached_path):
+            shutil.copyfile(cached_path, temporary_path(parquet_file_path))
+            metadata = pyarrow.parquet.read_metadata(temporary_path(parquet_file_path))
+        else:
+            if options.pop("nest_recommendations", False):
+                options["recommendations"] = read_nested_recommendations(
+                    zip_file,
+                    recommendations_member(zip_file, member),
+                    options.get("block_size"),
+                )
+            metadata = csv_to_parquet(
+                functools.partial(zip_file.open, member),
+                temporary_path(parquet_file_path),
+                schema,
+                **options,
+            )
+            if cached_path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                shutil.copyfile(
+                    temporary_path(parquet_file_path), temporary_path(cached_path)
+                )
+                os.replace(temporary_path(cached_path), cached_path)
+    os.replace(temporary_path(parquet_file_path), parquet_file_path)
+    return {
+        "member": member_name,
+        "crc32": member.CRC,
+        "file_size": member.file_size,
+        "rows": metadata.num_rows,
+        "path": parquet_file_path,
+        "size": os.path.getsize(parquet_file_path),
+        "seconds": time.monotonic() - start,
+        "metadata": metadata,
+    }
+
+
+# Longest processing time first: handing out the largest members first keeps a
+# huge authority from starting last and leaving one worker running on its own.
+# Returns the members in the order to submit them and the predicted makespan,
+# in uncompressed bytes, of greedily assigning them to the least loaded worker.
+def schedule_members(members, workers):
+    ordered = sorted(members, key=lambda member: member.file_size, reverse=True)
+    loads = [0] * workers
+    for member in ordered:
+        heapq.heappush(loads, heapq.heappop(loads) + member.file_size)
+    return ordered, max(loads)
+
+
+def run_conversions(epc_zipfile, members, tasks, workers):
+    if workers == 1:
+        for member in members:
+            schema, parquet_file_path, _, options = tasks[member.filename]
+            yield convert_member(
+                epc_zipfile, member.filename, parquet_file_path, schema, **options
+            )
+        return
+
+    start = time.monotonic()
+    scheduled, predicted_makespan = schedule_members(members, workers)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                convert_member,
+                epc_zipfile,
+                member.filename,
+                tasks[member.filename][1],
+                tasks[member.filename][0],
+                **tasks[member.filename][3],
+            )
+            for member in scheduled
+        ]
+        records = []
+        for future in concurrent.futures.as_completed(futures):
+            records.append(future.result())
+            yield records[-1]
+
+    # Convert the predicted makespan from bytes to seconds using the throughput
+    # the workers actually achieved.
+    busy_seconds = sum(record["seconds"] for record in records)
+    total_bytes = sum(member.file_size for member in members)
+    if total_bytes and busy_seconds:
+        predicted = predicted_makespan * busy_seconds / total_bytes
+        actual = time.monotonic() - start
+        print(f"Predicted finish {predicted:.1f}s, actual finish {actual:.1f}s")
+
+
+LOCAL_AUTHORITY_PARTITION = "LOCAL_AUTHORITY_CODE"
+
+
+# Members of the bulk download are stored in one folder per local authority,
+# named like domestic-E08000025-Birmingham.
+def local_authority(member_name):
+    folder = posixpath.dirname(member_name)
+    match = re.search(r"\b[EW]\d{8}\b", folder)
+    return match.group() if match else folder.replace("/", "_")
+
+
+# Each dataset is a (file_pattern, schema, output_path) tuple, optionally
+# followed by a dict of conversion options for that dataset alone, which take
+# precedence over those shared by all datasets. The zip's central
+# directory is read once and every member is routed to the first dataset whose
+# pattern it matches, so all datasets are converted together by one pool.
+#
+# Every dataset gets a manifest of the members converted into it. With resume,
+# members the manifest shows were already converted, with the same schema and
+# options, are skipped. Once all members are converted, the parts' footers are
+# consolidated into _metadata.
+#
+# With exclude_keys_from, a certificates dataset, only rows whose LMK_KEY is not
+# in it are written.
+#
+# With partition_by="local-authority" parts are written to a hive layout, e.g.
+# LOCAL_AUTHORITY_CODE=E08000025/part-000.parquet, so queries filtering on the
+# authority can skip whole directories. The key is not LOCAL_AUTHORITY, which
+# certificates already have as a column of another type.
+def convert_datasets(
+    epc_zipfile,
+    datasets,
+    workers=1,
+    resume=False,
+    partition_by=None,
+    exclude_keys_from=None,
+    **options,
+):
+    with zipfile.ZipFile(epc_zipfile, "r") as zip_file:
+        infolist = zip_file.infolist()
+
+    members = []
+    tasks = {}
+    part_numbers = {}
+    for member in infolist:
+        for index, (file_pattern, schema, output_path, *dataset_options) in enumerate(
+            datasets
+        ):
+            if fnmatch.fnmatch(member.filename, file_pattern):
+                partition = ""
+                if partition_by == "local-authority":
+                    partition = f"{LOCAL_AUTHORITY_PARTITION}={local_authority(member.filename)}"
+                # Part numbers follow the order of members in the zip, not
+                # completion order, and start again in each partition.
+                part_number = part_numbers.get((index, partition), 0)
+                part_numbers[index, partition] = part_number + 1
+                part_name = os.path.join(partition, f"part-{part_number:03}.parquet")
+                members.append(member)
+                tasks[member.filename] = (
+                    schema,
+                    os.path.join(output_path, part_name),
+                    output_path,
+                    {**options, **(dataset_options[0] if dataset_options else {})},
+                )
+                break
+
+    manifests = {}
+    file_metadata = {}
+    for _, _, output_path, *_ in datasets:
+        os.makedirs(output_path, exist_ok=True)
+        manifests[output_path] = read_manifest(output_path) if resume else {}
+        file_metadata[output_path] = {}
+
+    # The cache directory doesn't change what a member converts to, whereas the
+    # dataset its known keys come from does.
+    keys = {}
+    with zipfile.ZipFile(epc_zipfile, "r") as zip_file:
+        for member in members:
+            schema, _, _, member_options = tasks[member.filename]
+            key_options = {
+                name: value
+                for name, value in member_options.items()
+                if name != "cache_dir"
+            }
+            if exclude_keys_from is not None:
+                key_options["exclude_keys_from"] = os.path.abspath(exclude_keys_from)
+            keys[member.filename] = conversion_key(
+                zip_file, member, schema, key_options
+            )
+
+    pending = []
+    for member in members:
+        _, parquet_file_path, output_path, _ = tasks[member.filename]
+        manifest_entry = manifests[output_path].get(member.filename)
+        if resume and is_converted(
+            manifest_entry,
+            member,
+            keys[member.filename],
+            parquet_file_path,
+            output_path,
+        ):
+            print(f"Skipping {parquet_file_path}, already converted")
+            file_metadata[output_path][parquet_file_path] = (
+                pyarrow.parquet.read_metadata(parquet_file_path)
+            )
+        else:
+            manifests[output_path].pop(member.filename, None)
+            pending.append(member)
+
+    with contextlib.ExitStack() as stack:
+        # The previous dataset's keys are written to a lookup once here, which
+        # every worker then memory maps.
+        if exclude_keys_from is not None and pending:
+            lookup_path = os.path.join(
+                stack.enter_context(
+                    tempfile.TemporaryDirectory(prefix=".keys-", dir=datasets[0][2])
+                ),
+                "known_keys.arrow",
+            )
+            write_known_keys(exclude_keys_from, lookup_path)
+            for member in pending:
+                tasks[member.filename][3]["known_keys"] = lookup_path
+
+        for record in run_conversions(epc_zipfile, pending, tasks, workers):
+            print(f"Written {record['path']}")
+            output_path = tasks[record["member"]][2]
+            file_metadata[output_path][record["path"]] = record["metadata"]
+            manifests[output_path][record["member"]] = {
+                "crc32": record["crc32"],
+                "file_size": record["file_size"],
+                "key": keys[record["member"]],
+                "rows": record["rows"],
+                "path": os.path.relpath(record["path"], output_path),
+                "size": record["size"],
+            }
+            write_manifest(output_path, manifests[output_path])
+
+    for output_path, manifest in manifests.items():
+        write_manifest(output_path, manifest)
+        write_metadata_files(output_path, file_metadata[output_path])
+
+
+def convert_files(epc_zipfile, file_pattern, schema, output_path, **options):
+    convert_datasets(epc_zipfile, [(file_pattern, schema, output_path)], **options)
+
+
+# With columns, the certificates schema is cut down to just those columns and
+# LMK_KEY, so converting with project_to_schema skips the rest. A row_filter
+# only applies to certificates, since it is written against their columns, and
+# nest_recommendations embeds each certificate's recommendations in it.
+def epc_datasets(
+    output_path, columns=None, row_filter=None, nest_recommendations=False
+):
+    certificate_schema = CERTIFICATE_SCHEMA
+    if columns:
+        certificate_schema = {
+            column: type_
+            for column, type_ in CERTIFICATE_SCHEMA.items()
+            if column == "LMK_KEY" or column in columns
+        }
+    return [
+        (
+            "*/certificates.csv",
+            certificate_schema,
+            os.path.join(output_path, "certificates"),
+            {"row_filter": row_filter, "nest_recommendations": nest_recommendations},
+        ),
+        (
+            "*/recommendations.csv",
+            RECOMMENDATIONS_SCHEMA,
+            os.path.join(output_path, "recommendations"),
+            {},
+        ),
+    ]
+
+
+LODGEMENT_DATE_PARTITIONS = {
+    "lodgement-year": ["LODGEMENT_YEAR"],
+    "lodgement-month": ["LODGEMENT_YEAR", "LODGEMENT_MONTH"],
+}
+
+
+# Rewrites a certificates dataset into a hive layout partitioned by the year, or
+# year and month, of LODGEMENT_DATE, e.g. LODGEMENT_YEAR=2020/part-0.parquet.
+# Rows from every part are streamed through at most max_open_files writers: once
+# that many are open the least recently used one is closed, and rows arriving
+# later for its partition go to a new file. Files are compressed, and get bloom
+# filters and the page index, as they did when converting.
+def repartition_by_lodgement_date(
+    dataset_path,
+    output_path,
+    partition_by="lodgement-year",
+    max_open_files=64,
+    rows_per_group=64 * 1024,
+    compression="snappy",
+    compression_level=None,
+    column_compression=None,
+    bloom_filter_columns=None,
+    bloom_filter_fpp=0.05,
+    page_index=False,
+    data_page_size=None,
+):
+    dataset = open_dataset(dataset_path)
+    partition_schema = pyarrow.schema(
+        [(field, pyarrow.int64()) for field in LODGEMENT_DATE_PARTITIONS[partition_by]]
+    )
+    schema = pyarrow.unify_schemas([dataset.schema, partition_schema])
+
+    def partitioned_batches():
+        for batch in dataset.to_batches():
+            lodgement_date = batch["LODGEMENT_DATE"]
+            partition_columns = {
+                "LODGEMENT_YEAR": pyarrow.compute.year(lodgement_date),
+                "LODGEMENT_MONTH": pyarrow.compute.month(lodgement_date),
+            }
+            yield pyarrow.RecordBatch.from_arrays(
+                batch.columns
+                + [partition_columns[field] for field in partition_schema.names],
+                schema=schema,
+            )
+
+    file_metadata = {}
+    pyarrow.dataset.write_dataset(
+        partitioned_batches(),
+        output_path,
+        schema=schema,
+        format="parquet",
+        partitioning=pyarrow.dataset.partitioning(partition_schema, flavor="hive"),
+        basename_template="part-{i}.parquet",
+        file_options=pyarrow.dataset.ParquetFileFormat().make_write_options(
+            bloom_filter_options=bloom_filter_options(
+                dataset.schema, bloom_filter_columns, bloom_filter_fpp, rows_per_group
+            ),
+            write_page_index=page_index,
+            data_page_size=data_page_size,
+            **compression_options(
+                schema, compression, compression_level, column_compression
+            ),
+        ),
+        max_open_files=max_open_files,
+        min_rows_per_group=rows_per_group,
+        max_rows_per_group=rows_per_group,
+        existing_data_behavior="delete_matching",
+        file_visitor=lambda written_file: file_metadata.__setitem__(
+            written_file.path, written_file.metadata
+        ),
+    )
+    write_metadata_files(output_path, file_metadata)
+
+
+# First fit decreasing: each part goes into the first bin it fits in, largest
+# parts first. A part larger than target_size gets a bin of its own.
+def pack_parts(part_sizes, target_size):
+    bins = []
+    for part, size in sorted(part_sizes.items(), key=lambda item: (-item[1], item[0])):
+        for bin_ in bins:
+            if bin_["size"] + size <= target_size:
+                bin_["parts"].append(part)
+                bin_["size"] += size
+                break
+        else:
+            bins.append({"parts": [part], "size": size})
+    return [sorted(bin_["parts"]) for bin_ in bins]
+
+
+# The sorting_columns every row group of parts was written with, or None if
+# they differ.
+def common_sorting_columns(parts):
+    sorting_columns = set()
+    for part in parts:
+        metadata = pyarrow.parquet.read_metadata(part)
+        sorting_columns.update(
+            metadata.row_group(row_group).sorting_columns
+            for row_group in range(metadata.num_row_groups)
+        )
+    if len(sorting_columns) != 1:
+        return None
+    return sorting_columns.pop() or None
+
+
+# Rewrites the parts of a dataset, directory by directory, into files of about
+# target_size bytes each, replacing whatever is at output_path. Parts are copied
+# a row group at a time. Small row groups from the same part are merged up to
+# rows_per_group, but a row group never mixes rows from two parts, so row
+# groups stay aligned to local authority boundaries, and parts sorted the same
+# way give a file declaring that sort. Files are compressed, and get bloom
+# filters and the page index, as they did when converting.
+def compact_dataset(
+    dataset_path,
+    output_path,
+    target_size,
+    rows_per_group=1024**2,
+    compression="snappy",
+    compression_level=None,
+    column_compression=None,
+    bloom_filter_columns=None,
+    bloom_filter_fpp=0.05,
+    page_index=False,
+    data_page_size=None,
+):
+    directories = {}
+    for directory, subdirectories, file_names in os.walk(dataset_path):
+        subdirectories[:] = sorted(
+            name for name in subdirectories if not name.startswith((".", "_"))
+        )
+        directories[os.path.relpath(directory, dataset_path)] = {
+            os.path.join(directory, name): os.path.getsize(
+                os.path.join(directory, name)
+            )
+            for name in file_names
+            if name.endswith(".parquet") and not name.startswith((".", "_"))
+        }
+
+    shutil.rmtree(output_path, ignore_errors=True)
+    file_metadata = {}
+    for directory, part_sizes in directories.items():
+        if not part_sizes:
+            continue
+        os.makedirs(os.path.join(output_path, directory), exist_ok=True)
+        schema = pyarrow.unify_schemas(
+            [pyarrow.parquet.read_schema(part) for part in sorted(part_sizes)],
+            promote_options="permissive",
+        )
+        for bin_number, parts in enumerate(pack_parts(part_sizes, target_size)):
+            compacted_path = os.path.normpath(
+                os.path.join(output_path, directory, f"part-{bin_number:03}.parquet")
+            )
+            metadata_collector = []
+            with pyarrow.parquet.ParquetWriter(
+                compacted_path,
+                schema,
+                sorting_columns=common_sorting_columns(parts),
+                metadata_collector=metadata_collector,
+                bloom_filter_options=bloom_filter_options(
+                    schema, bloom_filter_columns, bloom_filter_fpp, rows_per_group
+                ),
+                write_page_index=page_index,
+                data_page_size=data_page_size,
+                **compression_options(
+                    schema, compression, compression_level, column_compression
+                ),
+            ) as writer:
+                for part in parts:
+                    parquet_file = pyarrow.parquet.ParquetFile(part)
+                    pending = []
+                    for row_group in range(parquet_file.num_row_groups):
+                        pending.append(parquet_file.read_row_group(row_group))
+                        if sum(table.num_rows for table in pending) >= rows_per_group:
+                            writer.write_table(
+                                pyarrow.concat_tables(pending).cast(schema),
+                                row_group_size=rows_per_group,
+                            )
+                            pending = []
+                    if pending:
+                        writer.write_table(
+                            pyarrow.concat_tables(pending).cast(schema),
+                            row_group_size=rows_per_group,
+                        )
+            file_metadata[compacted_path] = metadata_collector[0]
+            print(f"Written {compacted_path}")
+    write_metadata_files(output_path, file_metadata)
+
+
+# Sums the compressed and uncompressed bytes of every column over all row groups
+# of all parts of a dataset, reading only the footers.
+def column_sizes(dataset_path):
+    sizes = {}
+    for directory, _, file_names in os.walk(dataset_path):
+        for file_name in sorted(file_names):
+            if not file_name.endswith(".parquet") or file_name.startswith((".", "_")):
+                continue
+            metadata = pyarrow.parquet.read_metadata(os.path.join(directory, file_name))
+            for row_group in range(metadata.num_row_groups):
+                for column in range(metadata.num_columns):
+                    column_chunk = metadata.row_group(row_group).column(column)
+                    compressed, uncompressed = sizes.get(
+                        column_chunk.path_in_schema, (0, 0)
+                    )
+                    sizes[column_chunk.path_in_schema] = (
+                        compressed + column_chunk.total_compressed_size,
+                        uncompressed + column_chunk.total_uncompressed_size,
+                    )
+    return sizes
+
+
+def print_column_sizes(dataset_path):
+    print(f"{dataset_path}:")
+    print(f"{'column':<32} {'compressed':>14} {'uncompressed':>14} {'ratio':>6}")
+    for column, (compressed, uncompressed) in column_sizes(dataset_path).items():
+        ratio = uncompressed / compressed if compressed else 0
+        print(f"{column:<32} {compressed:>14,} {uncompressed:>14,} {ratio:>6.2f}")
+
+
+# Parquet bloom filters hold the XXH64 hash of each value's plain encoding.
+XXH64_PRIMES = (
+    11400714785074694791,
+    14029467366897019727,
+    1609587929392839161,
+    9650029242287828579,
+    2870177450012600261,
+)
+MASK64 = 2**64 - 1
+
+
+def rotate_left(value, bits):
+    return ((value << bits) | (value >> (64 - bits))) & MASK64
+
+
+def xxh64(data, seed=0):
+    p1, p2, p3, p4, p5 = XXH64_PRIMES
+
+    def round_(accumulator, lane):
+        accumulator = (accumulator + lane * p2) & MASK64
+        return (rotate_left(accumulator, 31) * p1) & MASK64
+
+    def lane(offset, size=8):
+        return int.from_bytes(data[offset : offset + size], "little")
+
+    length, offset = len(data), 0
+    if length >= 32:
+        accumulators = [
+            (seed + p1 + p2) & MASK64,
+            (seed + p2) & MASK64,
+            seed,
+            (seed - p1) & MASK64,
+        ]
+        while offset + 32 <= length:
+            accumulators = [
+                round_(accumulator, lane(offset + 8 * i))
+                for i, accumulator in enumerate(accumulators)
+            ]
+            offset += 32
+        digest = (
+            sum(
+                rotate_left(accumulator, bits)
+                for accumulator, bits in zip(accumulators, [1, 7, 12, 18])
+            )
+            & MASK64
+        )
+        for accumulator in accumulators:
+            digest ^= round_(0, accumulator)
+            digest = (digest * p1 + p4) & MASK64
+    else:
+        digest = (seed + p5) & MASK64
+    digest = (digest + length) & MASK64
+    while offset + 8 <= length:
+        digest ^= round_(0, lane(offset))
+        digest = (rotate_left(digest, 27) * p1 + p4) & MASK64
+        offset += 8
+    if offset + 4 <= length:
+        digest ^= (lane(offset, 4) * p1) & MASK64
+        digest = (rotate_left(digest, 23) * p2 + p3) & MASK64
+        offset += 4
+    while offset < length:
+        digest ^= (data[offset] * p5) & MASK64
+        digest = (rotate_left(digest, 11) * p1) & MASK64
+        offset += 1
+    digest ^= digest >> 33
+    digest = (digest * p2) & MASK64
+    digest ^= digest >> 29
+    digest = (digest * p3) & MASK64
+    return digest ^ (digest >> 32)
+
+
+def plain_encoding(value, type_):
+    if pyarrow.types.is_dictionary(type_):
+        type_ = type_.value_type
+    if pyarrow.types.is_string(type_) or pyarrow.types.is_large_string(type_):
+        return value.encode()
+    # Parquet stores integers narrower than 32 bits as INT32
+    if pyarrow.types.is_integer(type_) and type_.bit_width < 32:
+        type_ = pyarrow.int32()
+    return pyarrow.array([value], type_).buffers()[1].to_pybytes()
 
 
-def convert_files(epc_zipfile, file_pattern, schema, output_path):
-    files = open_files(
-        epc_zipfile,
-        file_pattern,
+def plain_decoding(data, type_):
+    if pyarrow.types.is_dictionary(type_):
+        type_ = type_.value_type
+    if pyarrow.types.is_string(type_) or pyarrow.types.is_large_string(type_):
+        return data.decode()
+    if pyarrow.types.is_integer(type_) and type_.bit_width < 32:
+        return pyarrow.Array.from_buffers(
+            pyarrow.int32(), 1, [None, pyarrow.py_buffer(data)]
+        )[0].as_py()
+    return pyarrow.Array.from_buffers(type_, 1, [None, pyarrow.py_buffer(data)])[
+        0
+    ].as_py()
+
+
+# Parquet metadata is serialised with thrift's compact protocol. Structs are
+# read into dicts keyed on field id, which is all the page index and bloom
+# filter headers need. Returns the struct and the position after it.
+def read_thrift(data, position=0):
+    def read_varint():
+        nonlocal position
+        value = shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                return value
+
+    def read_zigzag():
+        value = read_varint()
+        return (value >> 1) ^ -(value & 1)
+
+    def read_bytes(length):
+        nonlocal position
+        position += length
+        return bytes(data[position - length : position])
+
+    # Booleans are stored in a struct's field header, but as a byte in lists
+    def read_element(type_):
+        if type_ in (1, 2):
+            return read_bytes(1) == b"\x01"
+        return read_value(type_)
+
+    def read_value(type_):
+        if type_ in (1, 2):
+            return type_ == 1
+        if type_ == 3:
+            return int.from_bytes(read_bytes(1), "little", signed=True)
+        if type_ in (4, 5, 6):
+            return read_zigzag()
+        if type_ == 7:
+            return memoryview(read_bytes(8)).cast("d")[0]
+        if type_ == 8:
+            return read_bytes(read_varint())
+        if type_ in (9, 10):
+            header = read_bytes(1)[0]
+            size = header >> 4
+            if size == 15:
+                size = read_varint()
+            return [read_element(header & 0x0F) for _ in range(size)]
+        if type_ == 11:
+            size = read_varint()
+            types = read_bytes(1)[0] if size else 0
+            return {
+                read_element(types >> 4): read_element(types & 0x0F)
+                for _ in range(size)
+            }
+        if type_ == 12:
+            return read_struct()
+        raise ValueError(f"Unknown thrift type {type_}")
+
+    def read_struct():
+        fields, field_id = {}, 0
+        while True:
+            header = read_bytes(1)[0]
+            if header == 0:
+                return fields
+            delta = header >> 4
+            field_id = field_id + delta if delta else read_zigzag()
+            fields[field_id] = read_value(header & 0x0F)
+
+    return read_struct(), position
+
+
+# The FileMetaData struct at the end of a Parquet file, which holds the page
+# index offsets that ParquetFile.metadata leaves out.
+def read_footer(file):
+    file.seek(-8, os.SEEK_END)
+    length = int.from_bytes(file.read(4), "little")
+    file.seek(-8 - length, os.SEEK_END)
+    return read_thrift(file.read(length))[0]
+
+
+BLOOM_FILTER_SALT = (
+    0x47B6137B,
+    0x44974D91,
+    0x8824AD5B,
+    0xA2B7289D,
+    0x705495C7,
+    0x2DF1424B,
+    0x9EFC4947,
+    0x5C6BFB31,
+)
+
+
+# A split block bloom filter is a thrift header, holding the bitset's size,
+# followed by the bitset: 32 byte blocks of eight 32 bit words. A value may be
+# present only if one bit is set in every word of the block its hash picks.
+def bloom_filter_contains(file, column_chunk, encoded_value):
+    file.seek(column_chunk.bloom_filter_offset)
+    data = file.read(column_chunk.bloom_filter_length)
+    header, position = read_thrift(data)
+    num_bytes = header[1]
+    bitset = data[position : position + num_bytes]
+
+    digest = xxh64(encoded_value)
+    block = ((digest >> 32) * (num_bytes // 32)) >> 32
+    key = digest & 0xFFFFFFFF
+    for word, salt in enumerate(BLOOM_FILTER_SALT):
+        start = block * 32 + word * 4
+        bits = int.from_bytes(bitset[start : start + 4], "little")
+        if not bits >> (((key * salt) & 0xFFFFFFFF) >> 27) & 1:
+            return False
+    return True
+
+
+# The ranges of rows in a row group whose pages' min/max, from the column index,
+# may include value. The offset index gives the first row of each page.
+def page_row_ranges(file, column_chunk, type_, value, num_rows):
+    file.seek(column_chunk[6])
+    column_index = read_thrift(file.read(column_chunk[7]))[0]
+    file.seek(column_chunk[4])
+    offset_index = read_thrift(file.read(column_chunk[5]))[0]
+    first_rows = [page[3] for page in offset_index[1]] + [num_rows]
+    return [
+        (first_rows[page], first_rows[page + 1])
+        for page, null_page in enumerate(column_index[1])
+        if not null_page
+        and plain_decoding(column_index[2][page], type_)
+        <= value
+        <= plain_decoding(column_index[3][page], type_)
+    ]
+
+
+# Decodes a row group batch_size rows at a time, by default one page's worth,
+# keeping only the rows in row_ranges and stopping after the last of them.
+def read_row_ranges(parquet_file, row_group, row_ranges, columns, batch_size=None):
+    batch_size = batch_size or row_ranges[0][1] - row_ranges[0][0]
+    batches, start = [], 0
+    for batch in parquet_file.iter_batches(
+        batch_size=batch_size, row_groups=[row_group], columns=columns
+    ):
+        end = start + batch.num_rows
+        for range_start, range_end in row_ranges:
+            if range_start < end and start < range_end:
+                batches.append(
+                    batch.slice(
+                        max(range_start, start) - start,
+                        min(range_end, end) - max(range_start, start),
+                    )
+                )
+        start = end
+        if start >= row_ranges[-1][1]:
+            break
+    schema = parquet_file.schema_arrow
+    if columns:
+        schema = pyarrow.schema([schema.field(name) for name in columns])
+    return pyarrow.Table.from_batches(batches, schema)
+
+
+# Reads the rows of a dataset where column equals value. Only the row groups
+# whose bloom filter on column may contain value are read, along with any row
+# groups written without one. In row groups with a page index, only the pages
+# whose min/max may include value are kept, and decoding stops after the last.
+def find_rows(dataset_path, column, value, columns=None):
+    tables, empty = [], None
+    read_columns = columns and list(dict.fromkeys([*columns, column]))
+    for fragment in pyarrow.dataset.dataset(
+        dataset_path, format="parquet"
+    ).get_fragments():
+        with open(fragment.path, "rb") as file:
+            parquet_file = pyarrow.parquet.ParquetFile(file)
+            schema = parquet_file.schema_arrow
+            if column not in schema.names:
+                continue
+            empty = schema.empty_table().select(columns or schema.names)
+            type_ = schema.field(column).type
+            encoded_value = plain_encoding(value, type_)
+            footer = None
+            row_groups, parts = [], []
+            for index in range(parquet_file.metadata.num_row_groups):
+                row_group = parquet_file.metadata.row_group(index)
+                position, column_chunk = next(
+                    (i, row_group.column(i))
+                    for i in range(row_group.num_columns)
+                    if row_group.column(i).path_in_schema == column
+                )
+                if column_chunk.bloom_filter_offset is not None:
+                    if not bloom_filter_contains(file, column_chunk, encoded_value):
+                        continue
+                if not column_chunk.has_column_index:
+                    row_groups.append(index)
+                    continue
+                footer = footer or read_footer(file)
+                row_ranges = page_row_ranges(
+                    file,
+                    footer[4][index][1][position],
+                    type_,
+                    value,
+                    row_group.num_rows,
+                )
+                if row_ranges:
+                    parts.append(
+                        read_row_ranges(parquet_file, index, row_ranges, read_columns)
+                    )
+            if row_groups:
+                parts.append(
+                    parquet_file.read_row_groups(row_groups, columns=read_columns)
+                )
+        for table in parts:
+            table = table.filter(pyarrow.compute.equal(decode(table[column]), value))
+            tables.append(table.select(columns or table.column_names))
+    if not tables:
+        return empty
+    return pyarrow.concat_tables(tables, promote_options="permissive")
+
+
+# Every printable ASCII character, for hashing strings with compute kernels:
+# index_in maps each character to its position here.
+HASH_ALPHABET = pyarrow.array([chr(code) for code in range(32, 127)])
+
+
+# A polynomial string hash built only from vectorised kernels, one pass per
+# character position. Integer multiplication wraps, so it works modulo 2**64.
+def hash_strings(values):
+    values = pyarrow.compute.fill_null(
+        pyarrow.compute.cast(values, pyarrow.string()), ""
     )
+    lengths = pyarrow.compute.utf8_length(values)
+    hashes = pyarrow.compute.cast(lengths, pyarrow.int64())
+    for position in range(pyarrow.compute.max(lengths).as_py() or 0):
+        characters = pyarrow.compute.utf8_slice_codeunits(
+            values, position, position + 1
+        )
+        codes = pyarrow.compute.fill_null(
+            pyarrow.compute.index_in(characters, value_set=HASH_ALPHABET),
+            len(HASH_ALPHABET),
+        )
+        hashes = pyarrow.compute.add(
+            pyarrow.compute.multiply(hashes, 1_000_003),
+            pyarrow.compute.cast(codes, pyarrow.int64()),
+        )
+    return hashes
+
+
+# Spills the columns of a dataset into one file per hash partition of key, so
+# each partition can later be processed on its own. The key is a column name or
+# a function returning the key of every row in a batch.
+def partition_dataset(dataset_path, columns, key, partitions, spill_path):
+    dataset = open_dataset(dataset_path)
+    schema = pyarrow.schema([dataset.schema.field(column) for column in columns])
+    os.makedirs(spill_path, exist_ok=True)
+    paths = [
+        os.path.join(spill_path, f"partition-{partition:03}.parquet")
+        for partition in range(partitions)
+    ]
+    writers = [pyarrow.parquet.ParquetWriter(path, schema) for path in paths]
+    try:
+        for batch in dataset.to_batches(columns=columns):
+            keys = key(batch) if callable(key) else batch[key]
+            batch_partitions = pyarrow.compute.modulo(hash_strings(keys), partitions)
+            for partition in pyarrow.compute.unique(batch_partitions).to_pylist():
+                writers[partition].write_batch(
+                    batch.filter(pyarrow.compute.equal(batch_partitions, partition))
+                )
+    finally:
+        for writer in writers:
+            writer.close()
+    return paths
+
+
+# Hashes every row of previous and current over columns. Values are dictionary
+# encoded across both tables together, so equal values get equal codes and the
+# hashes are comparable between the two. Either release may have been converted
+# with narrow_types, so both are cast to the type their columns unify to.
+def hash_rows(previous, current, columns):
+    previous_hashes = pyarrow.repeat(0, previous.num_rows)
+    current_hashes = pyarrow.repeat(0, current.num_rows)
+    schema = pyarrow.unify_schemas(
+        [
+            pyarrow.schema(
+                [(column, decode(table[column][:0]).type) for column in columns]
+            )
+            for table in [previous, current]
+        ],
+        promote_options="permissive",
+    )
+    for column in columns:
+        value_type = schema.field(column).type
+        previous_values = decode(previous[column]).cast(value_type)
+        current_values = decode(current[column]).cast(value_type)
+        values = pyarrow.chunked_array(
+            previous_values.chunks + current_values.chunks, value_type
+        )
+        codes = pyarrow.compute.cast(
+            pyarrow.compute.dictionary_encode(values, null_encoding="encode")
+            .combine_chunks()
+            .indices,
+            pyarrow.int64(),
+        )
+        previous_hashes = pyarrow.compute.add(
+            pyarrow.compute.multiply(previous_hashes, 1_000_003),
+            codes[: previous.num_rows],
+        )
+        current_hashes = pyarrow.compute.add(
+            pyarrow.compute.multiply(current_hashes, 1_000_003),
+            codes[previous.num_rows :],
+        )
+    return previous_hashes, current_hashes
+
+
+# Writes the LMK_KEYs inserted, updated and deleted between two certificates
+# datasets to inserted.parquet, updated.parquet and deleted.parquet. Both are
+# hash partitioned on LMK_KEY first, so only one partition of each is in memory
+# at a time.
+def diff_certificates(previous_path, current_path, output_path, partitions=64):
+    current_schema = open_dataset(current_path).schema
+    previous_schema = open_dataset(previous_path).schema
+    columns = [
+        column
+        for column in CERTIFICATE_SCHEMA
+        if column in current_schema.names and column in previous_schema.names
+    ]
+    compared_columns = [column for column in columns if column != "LMK_KEY"]
+
     os.makedirs(output_path, exist_ok=True)
+    key_schema = pyarrow.schema([("LMK_KEY", pyarrow.string())])
+    writers = {
+        change: pyarrow.parquet.ParquetWriter(
+            os.path.join(output_path, f"{change}.parquet"), key_schema
+        )
+        for change in ["inserted", "updated", "deleted"]
+    }
+    with tempfile.TemporaryDirectory(dir=output_path) as spill_path:
+        previous_partitions = partition_dataset(
+            previous_path,
+            columns,
+            "LMK_KEY",
+            partitions,
+            os.path.join(spill_path, "previous"),
+        )
+        current_partitions = partition_dataset(
+            current_path,
+            columns,
+            "LMK_KEY",
+            partitions,
+            os.path.join(spill_path, "current"),
+        )
+        try:
+            for previous_partition, current_partition in zip(
+                previous_partitions, current_partitions
+            ):
+                previous = pyarrow.parquet.read_table(previous_partition)
+                current = pyarrow.parquet.read_table(current_partition)
+                previous_hashes, current_hashes = hash_rows(
+                    previous, current, compared_columns
+                )
+                changes = pyarrow.table(
+                    {"LMK_KEY": previous["LMK_KEY"], "ROW_HASH": previous_hashes}
+                ).join(
+                    pyarrow.table(
+                        {"LMK_KEY": current["LMK_KEY"], "ROW_HASH": current_hashes}
+                    ),
+                    "LMK_KEY",
+                    join_type="full outer",
+                    left_suffix="_PREVIOUS",
+                    right_suffix="_CURRENT",
+                )
+                previous_hash = changes["ROW_HASH_PREVIOUS"]
+                current_hash = changes["ROW_HASH_CURRENT"]
+                masks = {
+                    "inserted": pyarrow.compute.is_null(previous_hash),
+                    "deleted": pyarrow.compute.is_null(current_hash),
+                    "updated": pyarrow.compute.fill_null(
+                        pyarrow.compute.not_equal(previous_hash, current_hash), False
+                    ),
+                }
+                for change, mask in masks.items():
+                    writers[change].write_table(
+                        changes.select(["LMK_KEY"]).filter(mask).cast(key_schema)
+                    )
+        finally:
+            for writer in writers.values():
+                writer.close()
 
-    for part_number, file in enumerate(files):
-        parquet_file_path = os.path.join(output_path, f"part-{part_number:03}.parquet")
-        csv_to_parquet(file, parquet_file_path, schema)
-        print(f"Written {parquet_file_path}")
+
+# Identifies the property a certificate is for by its UPRN, or its building
+# reference number when it has no UPRN.
+def property_keys(certificates):
+    keys = [
+        pyarrow.compute.binary_join_element_wise(
+            prefix, pyarrow.compute.cast(certificates[column], pyarrow.string()), ""
+        )
+        for prefix, column in [("U", "UPRN"), ("B", "BUILDING_REFERENCE_NUMBER")]
+    ]
+    return pyarrow.compute.coalesce(*keys)
+
+
+LATEST_CERTIFICATE_COLUMNS = [
+    "LMK_KEY",
+    "UPRN",
+    "BUILDING_REFERENCE_NUMBER",
+    "LODGEMENT_DATETIME",
+]
+
+
+# Writes the latest certificate for each property, by LODGEMENT_DATETIME, to
+# output_path. Certificates are hash partitioned on the property first, so only
+# one partition is in memory at a time. Certificates for properties with neither
+# a UPRN nor a building reference number are all kept.
+def latest_certificates(dataset_path, output_path, partitions=64):
+    columns = open_dataset(dataset_path).schema.names
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.makedirs(output_path)
+    with tempfile.TemporaryDirectory(dir=output_path) as spill_path:
+        partition_paths = partition_dataset(
+            dataset_path, columns, property_keys, partitions, spill_path
+        )
+        part_number = 0
+        for partition_path in partition_paths:
+            certificates = pyarrow.parquet.read_table(partition_path)
+            if not certificates.num_rows:
+                continue
+            certificates = certificates.append_column(
+                "PROPERTY_KEY", property_keys(certificates)
+            )
+            # Ties on LODGEMENT_DATETIME are broken by LMK_KEY so the output is
+            # deterministic.
+            certificates = sort_table(
+                certificates,
+                [
+                    ("PROPERTY_KEY", "ascending"),
+                    ("LODGEMENT_DATETIME", "descending"),
+                    ("LMK_KEY", "descending"),
+                ],
+            )
+            keys = certificates["PROPERTY_KEY"].combine_chunks()
+            is_latest = pyarrow.concat_arrays(
+                [
+                    pyarrow.array([True]),
+                    pyarrow.compute.fill_null(
+                        pyarrow.compute.not_equal(keys[1:], keys[:-1]), True
+                    ),
+                ]
+            )
+            latest_path = os.path.join(output_path, f"part-{part_number:03}.parquet")
+            pyarrow.parquet.write_table(
+                certificates.filter(is_latest).drop_columns(["PROPERTY_KEY"]),
+                latest_path,
+            )
+            part_number += 1
+            print(f"Written {latest_path}")
+
+
+KEY_INDEX_FILE_NAME = "_lmk_key_index.arrow"
+LOOKUP_BATCH_SIZE = 8 * 1024
+# A lookup still decodes its row group from the start up to the key, so with
+# --key-index row groups are capped at this many rows, which keeps lookups to
+# tens of milliseconds at the cost of somewhat larger files.
+KEY_INDEX_ROW_GROUP_SIZE = 2 * LOOKUP_BATCH_SIZE
+
+
+# Writes an index from the hash of every LMK_KEY in a dataset to the part file,
+# row group and row it is in, sorted on the hash. It is an uncompressed Arrow
+# IPC file, so lookups can memory map it rather than read it.
+def write_key_index(dataset_path):
+    files, locations = [], []
+    for part, fragment in enumerate(
+        pyarrow.dataset.dataset(dataset_path, format="parquet").get_fragments()
+    ):
+        files.append(os.path.relpath(fragment.path, dataset_path))
+        parquet_file = pyarrow.parquet.ParquetFile(fragment.path)
+        for row_group in range(parquet_file.num_row_groups):
+            keys = parquet_file.read_row_group(row_group, columns=["LMK_KEY"])
+            num_rows = keys.num_rows
+            locations.append(
+                pyarrow.table(
+                    {
+                        "HASH": hash_strings(keys["LMK_KEY"]),
+                        "PART": pyarrow.repeat(
+                            pyarrow.scalar(part, pyarrow.int32()), num_rows
+                        ),
+                        "ROW_GROUP": pyarrow.repeat(
+                            pyarrow.scalar(row_group, pyarrow.int32()), num_rows
+                        ),
+                        "ROW": pyarrow.array(range(num_rows), pyarrow.int32()),
+                    }
+                ).filter(pyarrow.compute.is_valid(keys["LMK_KEY"]))
+            )
+    schema = pyarrow.schema(
+        [
+            ("HASH", pyarrow.int64()),
+            ("PART", pyarrow.int32()),
+            ("ROW_GROUP", pyarrow.int32()),
+            ("ROW", pyarrow.int32()),
+        ],
+        {"files": json.dumps(files)},
+    )
+    index = pyarrow.concat_tables(locations or [schema.empty_table()])
+    index = (
+        index.sort_by("HASH").combine_chunks().replace_schema_metadata(schema.metadata)
+    )
+
+    index_path = os.path.join(dataset_path, KEY_INDEX_FILE_NAME)
+    with pyarrow.ipc.new_file(temporary_path(index_path), index.schema) as writer:
+        writer.write_table(index, max_chunksize=max(index.num_rows, 1))
+    os.replace(temporary_path(index_path), index_path)
+    print(f"Written {index_path}")
+
+
+# Cached on the index's modification time, so a rebuilt index is mapped again.
+# The hashes are viewed as a memoryview of int64s, which bisect can search.
+@functools.lru_cache(maxsize=8)
+def open_key_index(index_path, modified):
+    reader = pyarrow.ipc.open_file(pyarrow.memory_map(index_path))
+    files = json.loads(reader.schema.metadata[b"files"])
+    if not reader.num_record_batches:
+        return files, [], None
+    index = reader.get_batch(0)
+    hashes = index["HASH"]
+    view = memoryview(hashes.buffers()[1]).cast("q")
+    return files, view[hashes.offset : hashes.offset + len(hashes)], index
+
+
+# Reads the rows with lmk_key from a dataset with a key index. Only the row
+# groups holding keys with the same hash are read, and only up to the batch of
+# LOOKUP_BATCH_SIZE rows holding the last of those keys, rather than decoding
+# the whole row group. Rows whose LMK_KEY only shares the hash are dropped.
+def lookup_key(dataset_path, lmk_key, columns=None):
+    index_path = os.path.join(dataset_path, KEY_INDEX_FILE_NAME)
+    files, hashes, index = open_key_index(index_path, os.path.getmtime(index_path))
+    key_hash = hash_strings(pyarrow.array([lmk_key]))[0].as_py()
+    row_groups = {}
+    for position in range(
+        bisect.bisect_left(hashes, key_hash), bisect.bisect_right(hashes, key_hash)
+    ):
+        part, row_group, row = (
+            index[column][position].as_py() for column in ["PART", "ROW_GROUP", "ROW"]
+        )
+        row_groups.setdefault((part, row_group), []).append(row)
+
+    tables = []
+    read_columns = columns and list(dict.fromkeys([*columns, "LMK_KEY"]))
+    for (part, row_group), rows in row_groups.items():
+        parquet_file = pyarrow.parquet.ParquetFile(
+            os.path.join(dataset_path, files[part])
+        )
+        table = read_row_ranges(
+            parquet_file,
+            row_group,
+            [(row, row + 1) for row in sorted(rows)],
+            read_columns,
+            batch_size=LOOKUP_BATCH_SIZE,
+        )
+        table = table.filter(pyarrow.compute.equal(decode(table["LMK_KEY"]), lmk_key))
+        tables.append(table.select(columns or table.column_names))
+    if not tables:
+        return None
+    return pyarrow.concat_tables(tables, promote_options="permissive")
+
+
+# The certificate with lmk_key in the output of a run with --key-index, as a
+# dict, or None if there is no such certificate.
+def get_certificate(output_path, lmk_key):
+    certificates = lookup_key(os.path.join(output_path, "certificates"), lmk_key)
+    if certificates is None or not certificates.num_rows:
+        return None
+    return certificates.to_pylist()[0]
+
+
+def get_recommendations(output_path, lmk_key):
+    recommendations = lookup_key(os.path.join(output_path, "recommendations"), lmk_key)
+    return recommendations.to_pylist() if recommendations is not None else []
 
 
 if __name__ == "__main__":
     args = parse_args()
+    options = {
+        "workers": args.workers,
+        "resume": args.resume,
+        "partition_by": (
+            args.partition_by if args.partition_by == "local-authority" else None
+        ),
+        "cache_dir": args.cache_dir,
+        "block_size": args.block_size,
+        "exclude_keys_from": args.previous_certificates,
+        "sort_by": args.sort_by,
+        "row_group_size": args.row_group_size,
+        "compression": args.compression,
+        "compression_level": args.compression_level,
+        "column_compression": dict(args.column_compression or []),
+        "narrow_types": NARROW_TYPES if args.narrow_types else None,
+        "project_to_schema": bool(args.columns),
+        "bloom_filter_columns": args.bloom_filters,
+        "bloom_filter_fpp": args.bloom_filter_fpp,
+        "page_index": args.page_index,
+        "data_page_size": args.data_page_size,
+    }
+    # Options that datasets rewritten after conversion are written with too
+    rewrite_options = {
+        name: options[name]
+        for name in [
+            "compression",
+            "compression_level",
+            "column_compression",
+            "bloom_filter_columns",
+            "bloom_filter_fpp",
+            "page_index",
+            "data_page_size",
+        ]
+    }
 
-    convert_files(
-        args.epc_zipfile,
-        "*/certificates.csv",
-        CERTIFICATE_SCHEMA,
-        os.path.join(args.output_path, "certificates"),
-    )
+    if args.row_group_size:
+        rewrite_options["rows_per_group"] = args.row_group_size
 
-    convert_files(
-        args.epc_zipfile,
-        "*/recommendations.csv",
-        RECOMMENDATIONS_SCHEMA,
-        os.path.join(args.output_path, "recommendations"),
-    )
+    # Datasets that are rewritten after conversion are converted into a
+    # staging directory first.
+    staging_path = os.path.join(args.output_path, "_staging")
+    repartition = args.partition_by in LODGEMENT_DATE_PARTITIONS
+    datasets = []
+    for file_pattern, schema, dataset_path, dataset_options in epc_datasets(
+        args.output_path, args.columns, args.filter, args.nest_recommendations
+    ):
+        name = os.path.basename(dataset_path)
+        if args.compact_target_size or (repartition and name == "certificates"):
+            dataset_path = os.path.join(staging_path, name)
+        datasets.append((file_pattern, schema, dataset_path, dataset_options))
+
+    convert_datasets(args.epc_zipfile, datasets, **options)
+
+    certificates_path = os.path.join(args.output_path, "certificates")
+    if repartition:
+        repartitioned_path = certificates_path
+        if args.compact_target_size:
+            repartitioned_path = os.path.join(
+                staging_path, "repartitioned", "certificates"
+            )
+        repartition_by_lodgement_date(
+            os.path.join(staging_path, "certificates"),
+            repartitioned_path,
+            args.partition_by,
+            max_open_files=args.max_open_files,
+            **rewrite_options,
+        )
+        file_pattern, schema, _, dataset_options = datasets[0]
+        datasets[0] = (file_pattern, schema, repartitioned_path, dataset_options)
+
+    if args.compact_target_size:
+        for _, _, dataset_path, _ in datasets:
+            compact_dataset(
+                dataset_path,
+                os.path.join(args.output_path, os.path.basename(dataset_path)),
+                args.compact_target_size * 1024**2,
+                **rewrite_options,
+            )
+
+    shutil.rmtree(staging_path, ignore_errors=True)
+
+    if args.key_index:
+        for _, _, dataset_path, _ in epc_datasets(args.output_path):
+            write_key_index(dataset_path)
+
+    if args.column_sizes:
+        for _, _, dataset_path, _ in epc_datasets(args.output_path):
+            print_column_sizes(dataset_path)
+
+    if args.latest:
+        latest_certificates(certificates_path, os.path.join(args.output_path, "latest"))
+
+    if args.diff_against:
+        diff_certificates(
+            args.diff_against,
+            certificates_path,
+            os.path.join(args.output_path, "changes"),
+        )
@@ -0,0 +1,616 @@
+import argparse
+import contextlib
+import io
+import itertools
+import math
+import random
+import zipfile
+
+import pyarrow
+import pyarrow.compute
+import pyarrow.csv
+
+from epc import CATEGORY, CERTIFICATE_SCHEMA, RECOMMENDATIONS_SCHEMA
+
+# Generates a zip laid out like the bulk download, one folder per local
+# authority holding certificates.csv and recommendations.csv, with every column
+# of CERTIFICATE_SCHEMA and RECOMMENDATIONS_SCHEMA filled with plausible values.
+# Columns are generated with compute kernels rather than row by row, so tens of
+# gigabytes can be generated in reasonable time.
+
+ENGLISH_AUTHORITIES = 326
+WELSH_AUTHORITIES = 22
+CHUNK_ROWS = 64 * 1024
+
+PLACES = [
+    "Barnsley",
+    "Bassetlaw",
+    "Breckland",
+    "Cherwell",
+    "Copeland",
+    "Dacorum",
+    "Fenland",
+    "Gedling",
+    "Halton",
+    "Hambleton",
+    "Kesteven",
+    "Mendip",
+    "Rother",
+    "Selby",
+    "Tandridge",
+    "Tyneside",
+    "Wealden",
+    "Wyre",
+]
+DIRECTIONS = ["", "North-", "South-", "East-", "West-", "Mid-"]
+STREET_NAMES = ["High", "Church", "Station", "Mill", "Park", "Victoria", "Green"]
+STREET_TYPES = ["Street", "Road", "Lane", "Avenue", "Close", "Way", "Gardens"]
+
+EFFICIENCY = ["Good", "Average", "Poor", "Very Good", "Very Poor", "N/A"]
+CATEGORY_VALUES = {
+    "CURRENT_ENERGY_RATING": ["D", "C", "E", "B", "F", "G", "A"],
+    "POTENTIAL_ENERGY_RATING": ["C", "B", "D", "A", "E", "F", "G"],
+    "PROPERTY_TYPE": ["House", "Flat", "Bungalow", "Maisonette", "Park home"],
+    "BUILT_FORM": [
+        "Semi-Detached",
+        "Mid-Terrace",
+        "Detached",
+        "End-Terrace",
+        "Enclosed Mid-Terrace",
+        "Enclosed End-Terrace",
+        "NO DATA!",
+    ],
+    "TRANSACTION_TYPE": [
+        "marketed sale",
+        "rental (private)",
+        "new dwelling",
+        "rental (social)",
+        "ECO assessment",
+        "none of the above",
+        "assessment for green deal",
+        "FiT application",
+        "non marketed sale",
+        "RHI application",
+    ],
+    "ENERGY_TARIFF": ["Single", "dual", "Unknown", "off-peak 7 hour", "NO DATA!"],
+    "MAINS_GAS_FLAG": ["Y", "N"],
+    "FLAT_TOP_STOREY": ["N", "Y"],
+    "GLAZED_TYPE": [
+        "double glazing installed during or after 2002",
+        "double glazing installed before 2002",
+        "double glazing, unknown install date",
+        "single glazing",
+        "triple glazing",
+        "secondary glazing",
+        "NO DATA!",
+    ],
+    "GLAZED_AREA": [
+        "Normal",
+        "More Than Typical",
+        "Less Than Typical",
+        "Much More Than Typical",
+        "Much Less Than Typical",
+        "NO DATA!",
+    ],
+    "HEAT_LOSS_CORRIDOR": ["NO DATA!", "no corridor", "unheated corridor"],
+    "SOLAR_WATER_HEATING_FLAG": ["N", "Y"],
+    "MECHANICAL_VENTILATION": [
+        "natural",
+        "mechanical, extract only",
+        "mechanical, supply and extract",
+        "NO DATA!",
+    ],
+    "CONSTRUCTION_AGE_BAND": [
+        "England and Wales: 1930-1949",
+        "England and Wales: 1900-1929",
+        "England and Wales: 1950-1966",
+        "England and Wales: 1967-1975",
+        "England and Wales: before 1900",
+        "England and Wales: 1983-1990",
+        "England and Wales: 1976-1982",
+        "England and Wales: 1996-2002",
+        "England and Wales: 2007 onwards",
+        "England and Wales: 1991-1995",
+        "England and Wales: 2003-2006",
+        "England and Wales: 2012 onwards",
+        "NO DATA!",
+        "INVALID!",
+    ],
+    "TENURE": [
+        "owner-occupied",
+        "rental (private)",
+        "rental (social)",
+        "Owner-occupied",
+        "Rented (private)",
+        "Rented (social)",
+        "NO DATA!",
+        "unknown",
+    ],
+    "UPRN_SOURCE": ["Address Matched", "Energy Assessor"],
+}
+STRING_VALUES = {
+    "FLOOR_LEVEL": ["Ground", "1st", "2nd", "3rd", "NODATA!", "00", "01", "02"],
+    "MAIN_HEATING_CONTROLS": ["2106", "2104", "2105", "2107", "2102", "2401", "2110"],
+    "MAIN_FUEL": [
+        "mains gas (not community)",
+        "electricity (not community)",
+        "oil (not community)",
+        "LPG (not community)",
+        "mains gas (community)",
+        "wood logs",
+        "NO DATA!",
+    ],
+}
+# Descriptions combine a few phrases, giving a few hundred distinct values
+DESCRIPTION_PHRASES = [
+    [
+        "Cavity wall",
+        "Solid brick",
+        "Timber frame",
+        "Pitched",
+        "Suspended",
+        "Boiler and radiators",
+        "Electric storage heaters",
+        "From main system",
+        "Room heaters",
+        "Fully double glazed",
+        "Low energy lighting in",
+    ],
+    [
+        "as built",
+        "filled cavity",
+        "no insulation (assumed)",
+        "insulated (assumed)",
+        "mains gas",
+        "electric",
+        "oil",
+        "50% of fixed outlets",
+        "all fixed outlets",
+    ],
+    [
+        "",
+        ", 270 mm loft insulation",
+        ", 100 mm loft insulation",
+        ", programmer, room thermostat and TRVs",
+        ", waste water heat recovery",
+        ", average thermal transmittance 0.25 W/m²K",
+    ],
+]
+
+# (low, high) of numeric columns; values are drawn between them, with counts
+# skewed towards low.
+NUMERIC_RANGES = {
+    "CURRENT_ENERGY_EFFICIENCY": (1, 100),
+    "POTENTIAL_ENERGY_EFFICIENCY": (1, 100),
+    "ENVIRONMENT_IMPACT_CURRENT": (1, 100),
+    "ENVIRONMENT_IMPACT_POTENTIAL": (1, 100),
+    "ENERGY_CONSUMPTION_CURRENT": (0, 600),
+    "ENERGY_CONSUMPTION_POTENTIAL": (0, 400),
+    "CO2_EMISSIONS_CURRENT": (0, 15),
+    "CO2_EMISS_CURR_PER_FLOOR_AREA": (0, 150),
+    "CO2_EMISSIONS_POTENTIAL": (0, 10),
+    "LIGHTING_COST_CURRENT": (20, 200),
+    "LIGHTING_COST_POTENTIAL": (20, 120),
+    "HEATING_COST_CURRENT": (100, 3000),
+    "HEATING_COST_POTENTIAL": (100, 2000),
+    "HOT_WATER_COST_CURRENT": (50, 500),
+    "HOT_WATER_COST_POTENTIAL": (50, 300),
+    "TOTAL_FLOOR_AREA": (20, 300),
+    "FLAT_STOREY_COUNT": (1, 20),
+    "MULTI_GLAZE_PROPORTION": (0, 100),
+    "EXTENSION_COUNT": (0, 4),
+    "NUMBER_HABITABLE_ROOMS": (1, 10),
+    "NUMBER_HEATED_ROOMS": (1, 10),
+    "LOW_ENERGY_LIGHTING": (0, 100),
+    "NUMBER_OPEN_FIREPLACES": (0, 3),
+    "WIND_TURBINE_COUNT": (0, 1),
+    "UNHEATED_CORRIDOR_LENGTH": (0, 20),
+    "FLOOR_HEIGHT": (2, 3.5),
+    "PHOTO_SUPPLY": (0, 100),
+    "FIXED_LIGHTING_OUTLETS_COUNT": (0, 40),
+    "LOW_ENERGY_FIXED_LIGHT_COUNT": (0, 40),
+}
+# Float columns that only ever hold whole numbers, e.g. 1.0
+WHOLE_NUMBER_COLUMNS = {
+    "MULTI_GLAZE_PROPORTION",
+    "EXTENSION_COUNT",
+    "NUMBER_HABITABLE_ROOMS",
+    "NUMBER_HEATED_ROOMS",
+    "WIND_TURBINE_COUNT",
+    "PHOTO_SUPPLY",
+    "FIXED_LIGHTING_OUTLETS_COUNT",
+    "LOW_ENERGY_FIXED_LIGHT_COUNT",
+}
+SKEWED_COLUMNS = {
+    "FLAT_STOREY_COUNT",
+    "EXTENSION_COUNT",
+    "NUMBER_OPEN_FIREPLACES",
+    "WIND_TURBINE_COUNT",
+    "UNHEATED_CORRIDOR_LENGTH",
+    "PHOTO_SUPPLY",
+}
+
+# Fraction of values left empty; other columns are empty 1% of the time
+NULL_RATES = {
+    "LMK_KEY": 0,
+    "ADDRESS1": 0,
+    "ADDRESS2": 0.6,
+    "ADDRESS3": 0.9,
+    "POSTCODE": 0,
+    "BUILDING_REFERENCE_NUMBER": 0,
+    "LOCAL_AUTHORITY": 0,
+    "LOCAL_AUTHORITY_LABEL": 0,
+    "LODGEMENT_DATE": 0,
+    "INSPECTION_DATE": 0,
+    "LODGEMENT_DATETIME": 0,
+    "ADDRESS": 0,
+    "FLOOR_LEVEL": 0.6,
+    "FLAT_TOP_STOREY": 0.7,
+    "FLAT_STOREY_COUNT": 0.8,
+    "UNHEATED_CORRIDOR_LENGTH": 0.85,
+    "FLOOR_HEIGHT": 0.3,
+    "PHOTO_SUPPLY": 0.2,
+    "SHEATING_ENERGY_EFF": 0.9,
+    "SHEATING_ENV_EFF": 0.9,
+    "UPRN": 0.1,
+    "UPRN_SOURCE": 0.1,
+    "IMPROVEMENT_SUMMARY_TEXT": 0.5,
+    "IMPROVEMENT_ID": 0.05,
+    "IMPROVEMENT_ID_TEXT": 0.05,
+    "INDICATIVE_COST": 0.1,
+}
+DEFAULT_NULL_RATE = 0.01
+
+IMPROVEMENTS = [
+    (5, "Increase loft insulation to 270 mm", "£100 - £350"),
+    (6, "Cavity wall insulation", "£500 - £1,500"),
+    (34, "Solar photovoltaic panels, 2.5 kWp", "£3,500 - £5,500"),
+    (35, "Low energy lighting for all fixed outlets", "£15"),
+    (19, "Solar water heating", "£4,000 - £6,000"),
+    (20, "Replace boiler with new condensing boiler", "£2,200 - £3,000"),
+    (7, "Floor insulation (solid floor)", "£4,000 - £6,000"),
+    (3, "Hot water cylinder thermostat", "£200 - £400"),
+    (1, "Insulate hot water cylinder with 80 mm jacket", "£15 - £30"),
+    (8, "Internal or external wall insulation", "£4,000 - £14,000"),
+    (16, "Heating controls (room thermostat and TRVs)", "£350 - £450"),
+    (48, "Replace single glazed windows with low-E double glazed windows", "£3,300"),
+]
+
+# 2008-10-01, when EPCs began to be lodged, and 2024-12-31, in days since 1970
+FIRST_LODGEMENT_DAY = 14153
+LAST_LODGEMENT_DAY = 20088
+
+
+def uniform(rng, n):
+    return pyarrow.compute.random(n, initializer=rng.getrandbits(63))
+
+
+# Picks from values, favouring those near the start when skew > 1
+def choose(rng, values, n, skew=1.0):
+    values = pyarrow.array(values) if isinstance(values, list) else values
+    indices = pyarrow.compute.floor(
+        pyarrow.compute.multiply(
+            pyarrow.compute.power(uniform(rng, n), skew), len(values)
+        )
+    )
+    return values.take(pyarrow.compute.cast(indices, pyarrow.int64()))
+
+
+def numbers(rng, n, low, high, skew=1.0):
+    return pyarrow.compute.add(
+        pyarrow.compute.multiply(
+            pyarrow.compute.power(uniform(rng, n), skew), high - low
+        ),
+        low,
+    )
+
+
+def with_nulls(rng, values, null_rate):
+    if not null_rate:
+        return values
+    return pyarrow.compute.if_else(
+        pyarrow.compute.less(uniform(rng, len(values)), null_rate),
+        pyarrow.scalar(None, values.type),
+        values,
+    )
+
+
+def join(separator, *columns):
+    return pyarrow.compute.binary_join_element_wise(
+        *columns, separator, null_handling="skip"
+    )
+
+
+# Everything that stays the same across a local authority's certificates
+def make_authority(rng, number, rows):
+    welsh = number >= ENGLISH_AUTHORITIES
+    code = (
+        f"W06{number - ENGLISH_AUTHORITIES + 1:06}" if welsh else f"E07{number + 1:06}"
+    )
+    name = rng.choice(DIRECTIONS) + rng.choice(PLACES)
+    area = "".join(rng.choice("ABCDEFGHJKLMNPRSTWY") for _ in range(2))
+    postcodes = [
+        f"{area}{rng.randint(1, 99)} {rng.randint(0, 9)}"
+        + "".join(rng.choice("ABDEFGHJLNPQRSTUWXYZ") for _ in range(2))
+        for _ in range(max(1, rows // 15))
+    ]
+    streets = [
+        f"{rng.choice(STREET_NAMES)} {rng.choice(STREET_TYPES)}"
+        for _ in range(max(1, rows // 60))
+    ]
+    return {
+        "number": number,
+        "code": code,
+        "name": name,
+        "folder": f"domestic-{code}-{name}",
+        "rows": rows,
+        "postcodes": pyarrow.array(postcodes),
+        "streets": pyarrow.array(streets),
+        "towns": [place.upper() for place in rng.sample(PLACES, 3)],
+        "constituencies": [
+            (f"{code[0]}14{number:03}{i:03}", f"{name} {direction}")
+            for i, direction in enumerate(["Central", "North", "South"])
+        ],
+        "county": rng.choice([None, f"{rng.choice(PLACES)}shire"]),
+    }
+
+
+def certificate_column(rng, column, type_, n, authority, first_row, columns):
+    if column == "LMK_KEY":
+        # Unique across the zip, and numeric like most real keys
+        first_key = 10**18 + authority["number"] * 10**9 + first_row
+        keys = pyarrow.compute.add(
+            pyarrow.compute.cumulative_sum(pyarrow.repeat(1, n)), first_key - 1
+        )
+        return pyarrow.compute.cast(keys, pyarrow.string())
+    if column == "ADDRESS1":
+        house_numbers = numbers(rng, n, 1, 200, skew=2)
+        return join(
+            " ",
+            pyarrow.compute.cast(
+                pyarrow.compute.cast(
+                    pyarrow.compute.floor(house_numbers), pyarrow.int64()
+                ),
+                pyarrow.string(),
+            ),
+            choose(rng, authority["streets"], n),
+        )
+    if column in ("ADDRESS2", "ADDRESS3"):
+        return choose(rng, [f"{place} Village" for place in PLACES], n)
+    if column == "ADDRESS":
+        return join(", ", columns["ADDRESS1"], columns["ADDRESS2"], columns["ADDRESS3"])
+    if column == "POSTCODE":
+        return choose(rng, authority["postcodes"], n)
+    if column == "POSTTOWN":
+        return choose(rng, authority["towns"], n, skew=2)
+    if column == "LOCAL_AUTHORITY":
+        return pyarrow.repeat(authority["code"], n)
+    if column == "LOCAL_AUTHORITY_LABEL":
+        return pyarrow.repeat(authority["name"], n)
+    if column in ("CONSTITUENCY", "CONSTITUENCY_LABEL"):
+        position = 0 if column == "CONSTITUENCY" else 1
+        return choose(
+            rng, [names[position] for names in authority["constituencies"]], n
+        )
+    if column == "COUNTY":
+        return pyarrow.repeat(pyarrow.scalar(authority["county"], pyarrow.string()), n)
+    if column in ("UPRN", "BUILDING_REFERENCE_NUMBER"):
+        # Roughly one property in four has been assessed more than once
+        properties = max(1, authority["rows"] * 3 // 4)
+        first_id = 10**8 * (authority["number"] + 1)
+        if column == "BUILDING_REFERENCE_NUMBER":
+            first_id += 10**11
+        return pyarrow.compute.cast(
+            pyarrow.compute.floor(numbers(rng, n, first_id, first_id + properties)),
+            pyarrow.int64(),
+        )
+    if column == "LODGEMENT_DATE":
+        days = numbers(rng, n, FIRST_LODGEMENT_DAY, LAST_LODGEMENT_DAY, skew=0.8)
+        days = pyarrow.compute.cast(pyarrow.compute.floor(days), pyarrow.int32())
+        return pyarrow.compute.cast(days, pyarrow.date32())
+    if column == "INSPECTION_DATE":
+        days = pyarrow.compute.subtract(
+            pyarrow.compute.cast(columns["LODGEMENT_DATE"], pyarrow.int32()),
+            pyarrow.compute.cast(
+                pyarrow.compute.floor(numbers(rng, n, 0, 30, skew=2)), pyarrow.int32()
+            ),
+        )
+        return pyarrow.compute.cast(days, pyarrow.date32())
+    if column == "LODGEMENT_DATETIME":
+        seconds = pyarrow.compute.add(
+            pyarrow.compute.multiply(
+                pyarrow.compute.cast(
+                    pyarrow.compute.cast(columns["LODGEMENT_DATE"], pyarrow.int32()),
+                    pyarrow.int64(),
+                ),
+                86400,
+            ),
+            pyarrow.compute.cast(
+                pyarrow.compute.floor(numbers(rng, n, 8 * 3600, 18 * 3600)),
+                pyarrow.int64(),
+            ),
+        )
+        return pyarrow.compute.cast(seconds, type_)
+    if column in CATEGORY_VALUES:
+        return choose(rng, CATEGORY_VALUES[column], n, skew=2)
+    if type_ == CATEGORY and column.endswith("_EFF"):
+        return choose(rng, EFFICIENCY, n, skew=1.5)
+    if column in STRING_VALUES:
+        return choose(rng, STRING_VALUES[column], n, skew=2)
+    if column.endswith("_DESCRIPTION"):
+        descriptions = [
+            f"{first}, {second}{third}"
+            for first, second, third in itertools.product(*DESCRIPTION_PHRASES)
+        ]
+        return choose(rng, rng.sample(descriptions, 200), n, skew=3)
+    if pyarrow.types.is_integer(type_) or pyarrow.types.is_floating(type_):
+        low, high = NUMERIC_RANGES.get(column, (0, 10))
+        skew = 3 if column in SKEWED_COLUMNS else 1
+        values = numbers(rng, n, low, high, skew)
+        if pyarrow.types.is_integer(type_) or column in WHOLE_NUMBER_COLUMNS:
+            values = pyarrow.compute.floor(values)
+        else:
+            values = pyarrow.compute.round(values, 2)
+        return pyarrow.compute.cast(values, type_)
+    return choose(rng, [f"{column.lower()}-{i}" for i in range(20)], n, skew=2)
+
+
+# Columns derived from others, so generated after every other column
+DERIVED_COLUMNS = {"ADDRESS", "INSPECTION_DATE", "LODGEMENT_DATETIME"}
+
+
+def certificates_table(rng, authority, first_row, n):
+    columns = {}
+    for column in sorted(CERTIFICATE_SCHEMA, key=lambda name: name in DERIVED_COLUMNS):
+        values = certificate_column(
+            rng, column, CERTIFICATE_SCHEMA[column], n, authority, first_row, columns
+        )
+        columns[column] = with_nulls(
+            rng, values, NULL_RATES.get(column, DEFAULT_NULL_RATE)
+        )
+    return pyarrow.table({column: columns[column] for column in CERTIFICATE_SCHEMA})
+
+
+# Between none and eight recommendations for each certificate, numbered from 1
+def recommendations_table(rng, lmk_keys):
+    counts = pyarrow.compute.cast(
+        pyarrow.compute.floor(numbers(rng, len(lmk_keys), 0, 9, skew=1.5)),
+        pyarrow.int32(),
+    )
+    offsets = pyarrow.concat_arrays(
+        [
+            pyarrow.array([0], pyarrow.int32()),
+            pyarrow.compute.cumulative_sum(counts),
+        ]
+    )
+    total = offsets[-1].as_py()
+    lists = pyarrow.ListArray.from_arrays(offsets, pyarrow.nulls(total))
+    parents = pyarrow.compute.list_parent_indices(lists)
+    positions = pyarrow.compute.subtract(
+        pyarrow.compute.cumulative_sum(pyarrow.repeat(1, total)),
+        pyarrow.compute.cast(offsets.take(parents), pyarrow.int64()),
+    )
+    improvements = pyarrow.compute.cast(
+        pyarrow.compute.floor(numbers(rng, total, 0, len(IMPROVEMENTS), skew=2)),
+        pyarrow.int64(),
+    )
+    ids, texts, costs = (pyarrow.array(values) for values in zip(*IMPROVEMENTS))
+    columns = {
+        "LMK_KEY": lmk_keys.take(parents),
+        "IMPROVEMENT_ITEM": positions,
+        "IMPROVEMENT_SUMMARY_TEXT": texts.take(improvements),
+        "IMPROVEMENT_DESCR_TEXT": texts.take(improvements),
+        "IMPROVEMENT_ID": ids.take(improvements),
+        "IMPROVEMENT_ID_TEXT": texts.take(improvements),
+        "INDICATIVE_COST": costs.take(improvements),
+    }
+    return pyarrow.table(
+        {
+            column: with_nulls(
+                rng,
+                pyarrow.compute.cast(values, RECOMMENDATIONS_SCHEMA[column]),
+                NULL_RATES.get(column, 0),
+            )
+            for column, values in columns.items()
+        }
+    )
+
+
+# Writes an authority's certificates, CHUNK_ROWS at a time, then their
+# recommendations, to the binary files open_member returns for each file name.
+# A zip can only have one member open for writing, so only the certificates'
+# keys are kept in between.
+def write_authority(rng, authority, open_member):
+    keys = []
+    with open_member("certificates.csv") as certificates_file:
+        writer = None
+        for first_row in range(0, authority["rows"], CHUNK_ROWS):
+            n = min(CHUNK_ROWS, authority["rows"] - first_row)
+            certificates = certificates_table(rng, authority, first_row, n)
+            if writer is None:
+                writer = pyarrow.csv.CSVWriter(certificates_file, certificates.schema)
+            writer.write_table(certificates)
+            keys.append(certificates["LMK_KEY"].combine_chunks())
+        writer.close()
+
+    with open_member("recommendations.csv") as recommendations_file:
+        writer = None
+        for chunk_keys in keys:
+            recommendations = recommendations_table(rng, chunk_keys)
+            if writer is None:
+                writer = pyarrow.csv.CSVWriter(
+                    recommendations_file, recommendations.schema
+                )
+            writer.write_table(recommendations)
+        writer.close()
+
+
+# CSV bytes per certificate, including its recommendations, measured on a
+# sample authority.
+def bytes_per_certificate(seed, sample_rows=2000):
+    rng = random.Random(seed)
+    authority = make_authority(rng, 0, sample_rows)
+    files = {}
+
+    def open_member(file_name):
+        files[file_name] = io.BytesIO()
+        return contextlib.nullcontext(files[file_name])
+
+    write_authority(rng, authority, open_member)
+    return sum(len(file.getvalue()) for file in files.values()) / sample_rows
+
+
+# Local authority sizes are log-normally distributed, so a few authorities are
+# many times the size of the median one, as in the real download.
+def authority_rows(rng, total_rows, authorities):
+    weights = [rng.lognormvariate(0, 1) for _ in range(authorities)]
+    return [
+        max(1, math.floor(total_rows * weight / sum(weights))) for weight in weights
+    ]
+
+
+# Writes about size_mb megabytes of uncompressed CSV to zip_path.
+def generate_epc_zip(zip_path, size_mb, seed=0, authorities=None):
+    total_rows = max(1, int(size_mb * 1024**2 / bytes_per_certificate(seed)))
+    if authorities is None:
+        authorities = ENGLISH_AUTHORITIES + WELSH_AUTHORITIES
+    authorities = max(1, min(authorities, total_rows // 1000))
+
+    rng = random.Random(seed)
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for number, rows in enumerate(authority_rows(rng, total_rows, authorities)):
+            authority = make_authority(rng, number, rows)
+            folder = authority["folder"]
+            write_authority(
+                rng,
+                authority,
+                lambda file_name: zip_file.open(
+                    f"{folder}/{file_name}", "w", force_zip64=True
+                ),
+            )
+            print(f"Written {folder} ({rows:,} certificates)")
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic EPC bulk download zip"
+    )
+    parser.add_argument("zip_path")
+    parser.add_argument(
+        "--size",
+        type=float,
+        default=10,
+        help="megabytes of uncompressed CSV to generate",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--authorities",
+        type=int,
+        help="number of local authority folders, at most one per 1000 certificates",
+    )
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    generate_epc_zip(args.zip_path, args.size, args.seed, args.authorities)
@@ -1,12 +1,46 @@
 import csv
 import io
+import json
 import zipfile
 
 import pyarrow
+import pyarrow.compute
+import pyarrow.dataset
 import pyarrow.parquet
 import pytest
 
-from epc import csv_to_parquet, open_files, parse_args
+from benchmark import STAGES, benchmark, compare_results
+from epc import (
+    CATEGORY,
+    CERTIFICATE_SCHEMA,
+    MANIFEST_FILE_NAME,
+    NARROW_TYPES,
+    RECOMMENDATIONS_SCHEMA,
+    column_sizes,
+    compact_dataset,
+    convert_datasets,
+    convert_files,
+    csv_to_parquet,
+    diff_certificates,
+    epc_datasets,
+    find_rows,
+    get_certificate,
+    get_recommendations,
+    hash_strings,
+    latest_certificates,
+    local_authority,
+    lookup_key,
+    open_dataset,
+    open_files,
+    pack_parts,
+    parse_args,
+    repartition_by_lodgement_date,
+    schedule_members,
+    sort_batches_externally,
+    write_key_index,
+    write_known_keys,
+)
+from generate_epc_zip import generate_epc_zip
 
 
 @pytest.fixture
@@ -20,6 +54,29 @@ def mock_epc_zipfile():
     yield file
 
 
+@pytest.fixture
+def epc_zipfile_path(tmp_path):
+    path = tmp_path / "all-domestic-certificates.zip"
+    with zipfile.ZipFile(path, "w") as zip_file:
+        for authority, rows in [
+            ("authority-1", 3),
+            ("authority-2", 1),
+            ("authority-3", 2),
+        ]:
+            certificates = ["LMK_KEY,POSTCODE"]
+            certificates += [f"{authority}-{i},AB1 2CD" for i in range(rows)]
+            zip_file.writestr(
+                f"{authority}/certificates.csv", "\n".join(certificates) + "\n"
+            )
+            recommendations = ["LMK_KEY,IMPROVEMENT_ITEM"]
+            recommendations += [f"{authority}-{i},1" for i in range(rows)]
+            zip_file.writestr(
+                f"{authority}/recommendations.csv",
+                "\n".join(recommendations) + "\n",
+            )
+    yield path
+
+
 def test_open_files(mock_epc_zipfile):
     certificates = open_files(mock_epc_zipfile, "*/certificates.csv")
     assert [certificate.read() for certificate in certificates] == [
@@ -53,7 +110,1123 @@ def test_csv_to_parquet(tmp_path):
     assert table["age"].type == "int8"
 
 
+def test_csv_to_parquet_streaming(tmp_path):
+    csv_file_path = tmp_path / "records.csv"
+    with open(csv_file_path, "w") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["name", "age"])
+        writer.writerows((f"Person {i}", i) for i in range(1000))
+
+    parquet_file_path = tmp_path / "records.parquet"
+    schema = {
+        "name": pyarrow.string(),
+        "age": pyarrow.int16(),
+    }
+    csv_to_parquet(csv_file_path, parquet_file_path, schema, block_size=1024)
+
+    # The blocks are regrouped rather than written as a row group each
+    parquet_file = pyarrow.parquet.ParquetFile(parquet_file_path)
+    assert parquet_file.metadata.num_row_groups == 1
+    table = parquet_file.read()
+    assert table.num_rows == 1000
+    assert table["age"].type == "int16"
+    assert table["age"].to_pylist() == list(range(1000))
+
+    csv_to_parquet(
+        csv_file_path, parquet_file_path, schema, block_size=1024, row_group_size=300
+    )
+    metadata = pyarrow.parquet.read_metadata(parquet_file_path)
+    assert [metadata.row_group(i).num_rows for i in range(4)] == [300, 300, 300, 100]
+
+
+def test_csv_to_parquet_streamed_row_group_bytes(tmp_path, monkeypatch):
+    csv_file_path = tmp_path / "records.csv"
+    with open(csv_file_path, "w") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["name"])
+        writer.writerows([f"Person {i:04}"] for i in range(1000))
+
+    # Without a row_group_size, a row group is also cut at a budget of bytes
+    monkeypatch.setattr("epc.STREAMED_ROW_GROUP_BYTES", 4000)
+    parquet_file_path = tmp_path / "records.parquet"
+    csv_to_parquet(
+        csv_file_path,
+        parquet_file_path,
+        {"name": pyarrow.string()},
+        block_size=1024,
+    )
+    # Each row is 11 bytes of string data and a 4 byte offset
+    metadata = pyarrow.parquet.read_metadata(parquet_file_path)
+    assert [metadata.row_group(i).num_rows for i in range(4)] == [267, 267, 267, 199]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_convert_files(epc_zipfile_path, tmp_path, workers):
+    output_path = tmp_path / "certificates"
+    schema = {"LMK_KEY": pyarrow.string(), "POSTCODE": pyarrow.string()}
+    convert_files(
+        epc_zipfile_path, "*/certificates.csv", schema, output_path, workers=workers
+    )
+
+    assert sorted(path.name for path in output_path.glob("*.parquet")) == [
+        "part-000.parquet",
+        "part-001.parquet",
+        "part-002.parquet",
+    ]
+    table = pyarrow.parquet.read_table(output_path / "part-001.parquet")
+    assert table["LMK_KEY"].to_pylist() == ["authority-2-0"]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_convert_datasets(epc_zipfile_path, tmp_path, workers):
+    datasets = [
+        (
+            "*/certificates.csv",
+            {"LMK_KEY": pyarrow.string()},
+            tmp_path / "certificates",
+        ),
+        (
+            "*/recommendations.csv",
+            {"LMK_KEY": pyarrow.string(), "IMPROVEMENT_ITEM": pyarrow.int64()},
+            tmp_path / "recommendations",
+        ),
+    ]
+    convert_datasets(epc_zipfile_path, datasets, workers=workers)
+
+    for dataset in ["certificates", "recommendations"]:
+        table = pyarrow.parquet.read_table(tmp_path / dataset / "part-002.parquet")
+        assert table["LMK_KEY"].to_pylist() == ["authority-3-0", "authority-3-1"]
+    recommendations = pyarrow.parquet.read_table(
+        tmp_path / "recommendations" / "part-000.parquet"
+    )
+    assert recommendations["IMPROVEMENT_ITEM"].type == "int64"
+
+
+def test_convert_files_partition_by_local_authority(epc_zipfile_path, tmp_path):
+    output_path = tmp_path / "certificates"
+    schema = {
+        "LMK_KEY": pyarrow.string(),
+        "POSTCODE": pyarrow.string(),
+        "LOCAL_AUTHORITY": CATEGORY,
+    }
+    convert_files(
+        epc_zipfile_path,
+        "*/certificates.csv",
+        schema,
+        output_path,
+        partition_by="local-authority",
+    )
+
+    part_path = output_path / "LOCAL_AUTHORITY_CODE=authority-2" / "part-000.parquet"
+    assert pyarrow.parquet.read_table(part_path)["LMK_KEY"].to_pylist() == [
+        "authority-2-0"
+    ]
+
+    # The partition key does not clash with the LOCAL_AUTHORITY column
+    dataset = pyarrow.dataset.dataset(output_path, partitioning="hive")
+    table = dataset.to_table(
+        filter=pyarrow.compute.field("LOCAL_AUTHORITY_CODE") == "authority-3"
+    )
+    assert sorted(table["LMK_KEY"].to_pylist()) == ["authority-3-0", "authority-3-1"]
+
+
+@pytest.mark.parametrize(
+    "member_name, expected",
+    [
+        ("domestic-E08000025-Birmingham/certificates.csv", "E08000025"),
+        ("domestic-W06000015-Cardiff/recommendations.csv", "W06000015"),
+        ("authority-1/certificates.csv", "authority-1"),
+    ],
+)
+def test_local_authority(member_name, expected):
+    assert local_authority(member_name) == expected
+
+
+def test_convert_files_nest_recommendations(epc_zipfile_path, tmp_path):
+    output_path = tmp_path / "certificates"
+    schema = {"LMK_KEY": pyarrow.string(), "POSTCODE": pyarrow.string()}
+    convert_files(
+        epc_zipfile_path,
+        "*/certificates.csv",
+        schema,
+        output_path,
+        nest_recommendations=True,
+    )
+
+    table = pyarrow.parquet.read_table(output_path / "part-000.parquet")
+    assert table.column_names == ["LMK_KEY", "POSTCODE", "RECOMMENDATIONS"]
+    assert table["RECOMMENDATIONS"].to_pylist() == [[{"IMPROVEMENT_ITEM": 1}]] * 3
+
+
+@pytest.mark.parametrize("block_size", [None, 32])
+def test_convert_files_nest_recommendations_lookup(tmp_path, block_size):
+    epc_zipfile_path = tmp_path / "all-domestic-certificates.zip"
+    with zipfile.ZipFile(epc_zipfile_path, "w") as zip_file:
+        zip_file.writestr("authority-1/certificates.csv", "LMK_KEY\nc\n0\nb\nz\nb\n")
+        zip_file.writestr(
+            "authority-1/recommendations.csv",
+            "LMK_KEY,IMPROVEMENT_ITEM\nb,2\nc,1\nb,1\n,3\n",
+        )
+    output_path = tmp_path / "certificates"
+    convert_files(
+        epc_zipfile_path,
+        "*/certificates.csv",
+        {"LMK_KEY": pyarrow.string()},
+        output_path,
+        nest_recommendations=True,
+        block_size=block_size,
+    )
+
+    # Keys before, between and after the recommendations' get null lists
+    table = pyarrow.parquet.read_table(output_path / "part-000.parquet")
+    assert table["RECOMMENDATIONS"].to_pylist() == [
+        [{"IMPROVEMENT_ITEM": 1}],
+        None,
+        [{"IMPROVEMENT_ITEM": 1}, {"IMPROVEMENT_ITEM": 2}],
+        None,
+        [{"IMPROVEMENT_ITEM": 1}, {"IMPROVEMENT_ITEM": 2}],
+    ]
+
+
+def test_get_certificate(epc_zipfile_path, tmp_path):
+    for file_pattern, _, dataset_path, _ in epc_datasets(tmp_path):
+        convert_files(
+            epc_zipfile_path,
+            file_pattern,
+            {"LMK_KEY": pyarrow.string()},
+            dataset_path,
+        )
+        write_key_index(dataset_path)
+
+    assert (tmp_path / "certificates" / "_lmk_key_index.arrow").exists()
+    assert get_certificate(tmp_path, "authority-3-1") == {
+        "LMK_KEY": "authority-3-1",
+        "POSTCODE": "AB1 2CD",
+    }
+    assert get_certificate(tmp_path, "authority-4-0") is None
+    assert get_recommendations(tmp_path, "authority-1-2") == [
+        {"LMK_KEY": "authority-1-2", "IMPROVEMENT_ITEM": 1}
+    ]
+
+
+def test_lookup_key_large_row_group(tmp_path):
+    # Keys of the same length, spread over several lookup batches of one row group
+    keys = [f"key-{i:05}" for i in range(20000)]
+    pyarrow.parquet.write_table(
+        pyarrow.table({"LMK_KEY": keys, "ROW": range(20000)}),
+        tmp_path / "part-000.parquet",
+    )
+    write_key_index(tmp_path)
+
+    for row in [0, 8191, 8192, 19999]:
+        assert lookup_key(tmp_path, keys[row]).to_pylist() == [
+            {"LMK_KEY": keys[row], "ROW": row}
+        ]
+    assert lookup_key(tmp_path, keys[12345], columns=["ROW"]).to_pylist() == [
+        {"ROW": 12345}
+    ]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_convert_files_metadata(epc_zipfile_path, tmp_path, workers):
+    output_path = tmp_path / "certificates"
+    schema = {"LMK_KEY": pyarrow.string(), "POSTCODE": pyarrow.string()}
+    convert_files(
+        epc_zipfile_path,
+        "*/certificates.csv",
+        schema,
+        output_path,
+        workers=workers,
+        partition_by="local-authority",
+    )
+
+    assert pyarrow.parquet.read_schema(output_path / "_common_metadata").names == [
+        "LMK_KEY",
+        "POSTCODE",
+    ]
+    metadata = pyarrow.parquet.read_metadata(output_path / "_metadata")
+    assert metadata.num_rows == 6
+    assert [
+        metadata.row_group(i).column(0).file_path
+        for i in range(metadata.num_row_groups)
+    ] == [
+        "LOCAL_AUTHORITY_CODE=authority-1/part-000.parquet",
+        "LOCAL_AUTHORITY_CODE=authority-2/part-000.parquet",
+        "LOCAL_AUTHORITY_CODE=authority-3/part-000.parquet",
+    ]
+    dataset = open_dataset(output_path)
+    assert sorted(dataset.files) == sorted(
+        str(output_path / path)
+        for path in [
+            "LOCAL_AUTHORITY_CODE=authority-1/part-000.parquet",
+            "LOCAL_AUTHORITY_CODE=authority-2/part-000.parquet",
+            "LOCAL_AUTHORITY_CODE=authority-3/part-000.parquet",
+        ]
+    )
+    assert dataset.to_table().num_rows == 6
+
+
+def test_convert_files_resume(epc_zipfile_path, tmp_path, capsys):
+    output_path = tmp_path / "certificates"
+    schema = {"LMK_KEY": pyarrow.string(), "POSTCODE": pyarrow.string()}
+    convert_files(epc_zipfile_path, "*/certificates.csv", schema, output_path)
+
+    with open(output_path / MANIFEST_FILE_NAME) as manifest_file:
+        manifest = json.load(manifest_file)
+    assert manifest["authority-1/certificates.csv"]["rows"] == 3
+    assert manifest["authority-1/certificates.csv"]["path"] == "part-000.parquet"
+
+    # Simulate a run that died before authority-3 was converted
+    (output_path / "part-002.parquet").unlink()
+    capsys.readouterr()
+    convert_files(
+        epc_zipfile_path, "*/certificates.csv", schema, output_path, resume=True
+    )
+
+    output = capsys.readouterr().out
+    assert "Skipping" in output and "part-000.parquet" in output
+    assert f"Written {output_path / 'part-002.parquet'}" in output
+    assert f"Written {output_path / 'part-000.parquet'}" not in output
+    assert pyarrow.parquet.read_table(output_path / "part-002.parquet").num_rows == 2
+
+    # Resuming with different options converts every member again
+    convert_files(
+        epc_zipfile_path,
+        "*/certificates.csv",
+        schema,
+        output_path,
+        resume=True,
+        compression="zstd",
+    )
+    output = capsys.readouterr().out
+    assert "Skipping" not in output
+    metadata = pyarrow.parquet.read_metadata(output_path / "part-000.parquet")
+    assert metadata.row_group(0).column(0).compression == "ZSTD"
+
+
+def test_convert_files_cache(epc_zipfile_path, tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    schema = {"LMK_KEY": pyarrow.string(), "POSTCODE": pyarrow.string()}
+    convert_files(
+        epc_zipfile_path,
+        "*/certificates.csv",
+        schema,
+        tmp_path / "first",
+        cache_dir=cache_dir,
+    )
+    assert len(list(cache_dir.glob("*.parquet"))) == 3
+
+    # A cached part is reused rather than converted again
+    cached_part = next(cache_dir.glob("*.parquet"))
+    pyarrow.parquet.write_table(pyarrow.table({"cached": [True]}), cached_part)
+    convert_files(
+        epc_zipfile_path,
+        "*/certificates.csv",
+        schema,
+        tmp_path / "second",
+        cache_dir=cache_dir,
+    )
+    tables = [
+        pyarrow.parquet.read_table(path)
+        for path in sorted((tmp_path / "second").glob("*.parquet"))
+    ]
+    assert sum(table.column_names == ["cached"] for table in tables) == 1
+
+    # Converting with a different schema misses the cache
+    convert_files(
+        epc_zipfile_path,
+        "*/certificates.csv",
+        {"LMK_KEY": pyarrow.string()},
+        tmp_path / "third",
+        cache_dir=cache_dir,
+    )
+    assert len(list(cache_dir.glob("*.parquet"))) == 6
+
+    # So does converting with another version of pyarrow
+    monkeypatch.setattr(pyarrow, "__version__", "0.0.0")
+    convert_files(
+        epc_zipfile_path,
+        "*/certificates.csv",
+        {"LMK_KEY": pyarrow.string()},
+        tmp_path / "fourth",
+        cache_dir=cache_dir,
+    )
+    assert len(list(cache_dir.glob("*.parquet"))) == 9
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_convert_datasets_row_filter(epc_zipfile_path, tmp_path, workers):
+    datasets = [
+        (
+            "*/certificates.csv",
+            {"LMK_KEY": pyarrow.string()},
+            tmp_path / "certificates",
+            {"row_filter": pyarrow.compute.field("LMK_KEY") != "authority-1-1"},
+        ),
+        (
+            "*/recommendations.csv",
+            {"LMK_KEY": pyarrow.string()},
+            tmp_path / "recommendations",
+        ),
+    ]
+    convert_datasets(epc_zipfile_path, datasets, workers=workers, block_size=1024)
+
+    certificates = pyarrow.parquet.read_table(
+        tmp_path / "certificates" / "part-000.parquet"
+    )
+    assert certificates["LMK_KEY"].to_pylist() == ["authority-1-0", "authority-1-2"]
+    recommendations = pyarrow.parquet.read_table(
+        tmp_path / "recommendations" / "part-000.parquet"
+    )
+    assert recommendations.num_rows == 3
+
+
+def test_schedule_members():
+    members = []
+    for name, size in [("a", 2), ("b", 7), ("c", 3), ("d", 5), ("e", 3)]:
+        member = zipfile.ZipInfo(name)
+        member.file_size = size
+        members.append(member)
+
+    ordered, makespan = schedule_members(members, workers=2)
+    assert [member.filename for member in ordered] == ["b", "d", "c", "e", "a"]
+    # One worker gets b and e, the other d, c and a.
+    assert makespan == 10
+
+
+@pytest.mark.parametrize("block_size", [None, 1024])
+def test_csv_to_parquet_sort_by(tmp_path, block_size):
+    postcodes = [f"AB{(i * 7919) % 1000:03} {i % 10}XY" for i in range(1000)]
+    csv_file_path = tmp_path / "certificates.csv"
+    with open(csv_file_path, "w") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["POSTCODE", "UPRN"])
+        writer.writerows((postcode, i) for i, postcode in enumerate(postcodes))
+        writer.writerow(["", 1000])
+
+    parquet_file_path = tmp_path / "certificates.parquet"
+    csv_to_parquet(
+        csv_file_path,
+        parquet_file_path,
+        {"POSTCODE": pyarrow.string(), "UPRN": pyarrow.int64()},
+        block_size=block_size,
+        sort_by=["POSTCODE", "UPRN", "MISSING"],
+        row_group_size=100,
+    )
+
+    parquet_file = pyarrow.parquet.ParquetFile(parquet_file_path)
+    metadata = parquet_file.metadata
+    assert metadata.num_row_groups == 11
+    assert [metadata.row_group(i).num_rows for i in range(11)] == [100] * 10 + [1]
+    assert metadata.row_group(0).sorting_columns[0].column_index == 0
+    table = parquet_file.read()
+    assert table["POSTCODE"].to_pylist() == sorted(postcodes + [""])
+    assert list(tmp_path.iterdir()) == [csv_file_path, parquet_file_path]
+
+    # Without a row_group_size, small blocks still make one row group
+    csv_to_parquet(
+        csv_file_path,
+        parquet_file_path,
+        {"POSTCODE": pyarrow.string(), "UPRN": pyarrow.int64()},
+        block_size=block_size,
+        sort_by=["POSTCODE"],
+    )
+    assert pyarrow.parquet.read_metadata(parquet_file_path).num_row_groups == 1
+
+
+def test_sort_batches_externally(tmp_path):
+    values = [(i * 7919) % 1000 for i in range(1000)] + [None]
+    table = pyarrow.table({"UPRN": values, "ROW": range(1001)})
+    batches = table.to_batches(max_chunksize=64)
+    sorted_tables = list(
+        sort_batches_externally(
+            table.schema,
+            batches,
+            [("UPRN", "ascending")],
+            tmp_path,
+            bucket_bytes=table.nbytes // 4,
+        )
+    )
+    assert 4 <= len(sorted_tables) <= 5
+    assert pyarrow.concat_tables(sorted_tables)["UPRN"].to_pylist() == sorted(
+        values[:-1]
+    ) + [None]
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("block_size", [None, 64])
+def test_csv_to_parquet_dictionary_columns(tmp_path, block_size):
+    csv_file_path = tmp_path / "certificates.csv"
+    with open(csv_file_path, "w") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["LMK_KEY", "CURRENT_ENERGY_RATING", "WALLS_ENERGY_EFF"])
+        writer.writerows((str(i), "ABCDEFG"[i % 7], "Good") for i in range(100))
+
+    parquet_file_path = tmp_path / "certificates.parquet"
+    csv_to_parquet(
+        csv_file_path,
+        parquet_file_path,
+        CERTIFICATE_SCHEMA,
+        block_size=block_size,
+        sort_by=["CURRENT_ENERGY_RATING"],
+    )
+
+    table = pyarrow.parquet.read_table(parquet_file_path)
+    assert table["LMK_KEY"].type == "string"
+    assert table["CURRENT_ENERGY_RATING"].type == pyarrow.dictionary(
+        pyarrow.int32(), pyarrow.string()
+    )
+    ratings = table["CURRENT_ENERGY_RATING"].to_pylist()
+    assert ratings == sorted("ABCDEFG"[i % 7] for i in range(100))
+    assert set(table["WALLS_ENERGY_EFF"].to_pylist()) == {"Good"}
+
+
+def test_csv_to_parquet_compression(tmp_path):
+    csv_file_path = tmp_path / "certificates.csv"
+    with open(csv_file_path, "w") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["WALLS_DESCRIPTION", "ROOF_DESCRIPTION", "UPRN"])
+        writer.writerows(
+            ("Cavity wall, filled cavity", "Pitched", i) for i in range(100)
+        )
+
+    parquet_file_path = tmp_path / "certificates.parquet"
+    csv_to_parquet(
+        csv_file_path,
+        parquet_file_path,
+        compression="lz4",
+        column_compression={"*_DESCRIPTION": ("zstd", 9)},
+    )
+
+    metadata = pyarrow.parquet.read_metadata(parquet_file_path)
+    assert [metadata.row_group(0).column(i).compression for i in range(3)] == [
+        "ZSTD",
+        "ZSTD",
+        "LZ4",
+    ]
+    sizes = column_sizes(tmp_path)
+    assert list(sizes) == ["WALLS_DESCRIPTION", "ROOF_DESCRIPTION", "UPRN"]
+    assert sizes["UPRN"][0] == metadata.row_group(0).column(2).total_compressed_size
+
+
+@pytest.mark.parametrize("block_size", [None, 128])
+def test_csv_to_parquet_narrow_types(tmp_path, block_size):
+    csv_file_path = tmp_path / "certificates.csv"
+    with open(csv_file_path, "w") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(
+            [
+                "EXTENSION_COUNT",
+                "NUMBER_OPEN_FIREPLACES",
+                "ENVIRONMENT_IMPACT_CURRENT",
+                "ENERGY_CONSUMPTION_CURRENT",
+                "TOTAL_FLOOR_AREA",
+            ]
+        )
+        writer.writerows(("1.0", i % 3, "72", "512", "") for i in range(100))
+        # Too many fireplaces for an int8, and an energy consumption float32
+        # would round, so the wide types are kept
+        writer.writerow(["2.0", 1000, "80.5", "1234.56", "80.25"])
+
+    # Both columns that don't fit are found in one attempt, and the CSV is
+    # opened again for the next
+    opened = []
+
+    def open_csv():
+        opened.append(True)
+        return open(csv_file_path, "rb")
+
+    parquet_file_path = tmp_path / "certificates.parquet"
+    csv_to_parquet(
+        open_csv,
+        parquet_file_path,
+        CERTIFICATE_SCHEMA,
+        narrow_types=NARROW_TYPES,
+        block_size=block_size,
+    )
+    assert len(opened) == 2
+
+    table = pyarrow.parquet.read_table(parquet_file_path)
+    assert table.schema.field("EXTENSION_COUNT").type == "int8"
+    assert table.schema.field("NUMBER_OPEN_FIREPLACES").type == "int64"
+    assert table.schema.field("ENVIRONMENT_IMPACT_CURRENT").type == "float"
+    assert table.schema.field("ENERGY_CONSUMPTION_CURRENT").type == "double"
+    assert table.schema.field("TOTAL_FLOOR_AREA").type == "double"
+    assert table.num_rows == 101
+    assert table["NUMBER_OPEN_FIREPLACES"][-1].as_py() == 1000
+    assert table["ENVIRONMENT_IMPACT_CURRENT"][-1].as_py() == 80.5
+    assert table["ENERGY_CONSUMPTION_CURRENT"][-1].as_py() == 1234.56
+
+
+def test_open_dataset_unifies_narrow_types(tmp_path):
+    for part_number, type_ in enumerate([pyarrow.int8(), pyarrow.int64()]):
+        pyarrow.parquet.write_table(
+            pyarrow.table({"NUMBER_OPEN_FIREPLACES": pyarrow.array([1], type_)}),
+            tmp_path / f"part-{part_number:03}.parquet",
+        )
+    pyarrow.parquet.write_table(
+        pyarrow.table({"NUMBER_OPEN_FIREPLACES": pyarrow.array([1000])}),
+        tmp_path / "part-002.parquet",
+    )
+
+    table = open_dataset(tmp_path).to_table()
+    assert table.schema.field("NUMBER_OPEN_FIREPLACES").type == "int64"
+    assert sorted(table["NUMBER_OPEN_FIREPLACES"].to_pylist()) == [1, 1, 1000]
+
+    # The unified schema is read from _common_metadata rather than every part
+    schema = pyarrow.schema({"NUMBER_OPEN_FIREPLACES": pyarrow.int32()})
+    pyarrow.parquet.write_metadata(schema, tmp_path / "_common_metadata")
+    table = open_dataset(tmp_path).to_table()
+    assert table.schema == schema
+    assert sorted(table["NUMBER_OPEN_FIREPLACES"].to_pylist()) == [1, 1, 1000]
+
+
+def test_csv_to_parquet_project_to_schema(tmp_path):
+    csv_file_path = tmp_path / "certificates.csv"
+    csv_file_path.write_text("LMK_KEY,ADDRESS,POSTCODE\n1,1 High Street,AB1 2CD\n")
+
+    parquet_file_path = tmp_path / "certificates.parquet"
+    schema = {
+        "POSTCODE": pyarrow.string(),
+        "LMK_KEY": pyarrow.string(),
+        "UPRN": pyarrow.int64(),
+    }
+    csv_to_parquet(csv_file_path, parquet_file_path, schema, project_to_schema=True)
+
+    table = pyarrow.parquet.read_table(parquet_file_path)
+    assert table.column_names == ["POSTCODE", "LMK_KEY", "UPRN"]
+    assert table.to_pylist() == [{"POSTCODE": "AB1 2CD", "LMK_KEY": "1", "UPRN": None}]
+
+
+def test_csv_to_parquet_exclude_keys_from(tmp_path):
+    previous_path = tmp_path / "previous"
+    previous_path.mkdir()
+    pyarrow.parquet.write_table(
+        pyarrow.table({"LMK_KEY": ["1", "2"]}), previous_path / "part-000.parquet"
+    )
+
+    lookup_path = tmp_path / "known_keys.arrow"
+    write_known_keys(previous_path, lookup_path)
+
+    csv_file_path = tmp_path / "certificates.csv"
+    csv_file_path.write_text("LMK_KEY,POSTCODE\n1,A\n2,B\n3,C\n,E\n0,F\n9,G\n")
+    parquet_file_path = tmp_path / "certificates.parquet"
+    csv_to_parquet(
+        csv_file_path,
+        parquet_file_path,
+        {"LMK_KEY": pyarrow.string()},
+        block_size=24,
+        known_keys=str(lookup_path),
+    )
+
+    table = pyarrow.parquet.read_table(parquet_file_path)
+    assert table["LMK_KEY"].to_pylist() == ["3", "", "0", "9"]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_convert_datasets_exclude_keys_from(epc_zipfile_path, tmp_path, workers):
+    previous_path = tmp_path / "previous"
+    previous_path.mkdir()
+    pyarrow.parquet.write_table(
+        pyarrow.table({"LMK_KEY": ["authority-1-0", "authority-3-1"]}),
+        previous_path / "part-000.parquet",
+    )
+
+    output_path = tmp_path / "parquet_files"
+    convert_datasets(
+        epc_zipfile_path,
+        epc_datasets(output_path),
+        workers=workers,
+        exclude_keys_from=str(previous_path),
+    )
+
+    for dataset in ["certificates", "recommendations"]:
+        keys = open_dataset(output_path / dataset).to_table()["LMK_KEY"]
+        assert sorted(keys.to_pylist()) == [
+            "authority-1-1",
+            "authority-1-2",
+            "authority-2-0",
+            "authority-3-0",
+        ]
+    # The lookup is removed once conversion finishes
+    assert not list((output_path / "certificates").glob(".keys-*"))
+
+
+def test_find_rows_bloom_filters(tmp_path, monkeypatch):
+    csv_file_path = tmp_path / "certificates.csv"
+    csv_file_path.write_text(
+        "LMK_KEY,UPRN\n" + "".join(f"{i},{i * 10}\n" for i in range(1000))
+    )
+    dataset_path = tmp_path / "certificates"
+    dataset_path.mkdir()
+    csv_to_parquet(
+        csv_file_path,
+        dataset_path / "part-000.parquet",
+        {"LMK_KEY": pyarrow.string(), "UPRN": pyarrow.int64()},
+        row_group_size=100,
+        bloom_filter_columns=["LMK_KEY", "UPRN"],
+        bloom_filter_fpp=0.001,
+    )
+
+    read_row_groups = pyarrow.parquet.ParquetFile.read_row_groups
+    row_groups_read = []
+
+    def spy(self, row_groups, **kwargs):
+        row_groups_read.append(row_groups)
+        return read_row_groups(self, row_groups, **kwargs)
+
+    monkeypatch.setattr(pyarrow.parquet.ParquetFile, "read_row_groups", spy)
+    assert find_rows(dataset_path, "LMK_KEY", "123").to_pylist() == [
+        {"LMK_KEY": "123", "UPRN": 1230}
+    ]
+    assert find_rows(dataset_path, "UPRN", 4560, ["LMK_KEY"]).to_pylist() == [
+        {"LMK_KEY": "456"}
+    ]
+    assert find_rows(dataset_path, "LMK_KEY", "missing").num_rows == 0
+    assert row_groups_read == [[1], [4]]
+
+
+def test_csv_to_parquet_bloom_filter_size(tmp_path):
+    csv_file_path = tmp_path / "certificates.csv"
+    csv_file_path.write_text(
+        "LMK_KEY,UPRN\n" + "".join(f"{i},{i}\n" for i in range(100000))
+    )
+
+    # A filter wraps the table in a generator, which mustn't shrink the filters
+    bloom_filter_lengths = []
+    for row_filter in [None, pyarrow.compute.field("UPRN") >= 0]:
+        parquet_file_path = tmp_path / "certificates.parquet"
+        csv_to_parquet(
+            csv_file_path,
+            parquet_file_path,
+            {"LMK_KEY": pyarrow.string(), "UPRN": pyarrow.int64()},
+            row_filter=row_filter,
+            bloom_filter_columns=["LMK_KEY"],
+        )
+        metadata = pyarrow.parquet.read_metadata(parquet_file_path)
+        assert metadata.num_row_groups == 1
+        bloom_filter_lengths.append(metadata.row_group(0).column(0).bloom_filter_length)
+    assert bloom_filter_lengths[0] == bloom_filter_lengths[1]
+
+
+def test_find_rows_page_index(tmp_path, monkeypatch):
+    csv_file_path = tmp_path / "certificates.csv"
+    csv_file_path.write_text(
+        "LMK_KEY,POSTCODE\n" + "".join(f"{i},P{i // 10:03d}\n" for i in range(5000))
+    )
+    dataset_path = tmp_path / "certificates"
+    dataset_path.mkdir()
+    csv_to_parquet(
+        csv_file_path,
+        dataset_path / "part-000.parquet",
+        {"LMK_KEY": pyarrow.string(), "POSTCODE": pyarrow.string()},
+        row_group_size=2500,
+        page_index=True,
+        data_page_size=256,
+    )
+    column_chunk = (
+        pyarrow.parquet.ParquetFile(dataset_path / "part-000.parquet")
+        .metadata.row_group(0)
+        .column(1)
+    )
+    assert column_chunk.has_column_index and column_chunk.has_offset_index
+
+    iter_batches = pyarrow.parquet.ParquetFile.iter_batches
+    rows_decoded = []
+
+    def spy(self, *args, **kwargs):
+        for batch in iter_batches(self, *args, **kwargs):
+            rows_decoded.append(batch.num_rows)
+            yield batch
+
+    monkeypatch.setattr(pyarrow.parquet.ParquetFile, "iter_batches", spy)
+    table = find_rows(dataset_path, "POSTCODE", "P012", ["LMK_KEY"])
+    assert table["LMK_KEY"].to_pylist() == [str(i) for i in range(120, 130)]
+    # Only the first row group is decoded, and only up to the matching page
+    assert 0 < sum(rows_decoded) < 2500
+
+
+@pytest.mark.parametrize(
+    "partition_by, expected_partitions",
+    [
+        ("lodgement-year", ["LODGEMENT_YEAR=2019", "LODGEMENT_YEAR=2020"]),
+        (
+            "lodgement-month",
+            [
+                "LODGEMENT_YEAR=2019/LODGEMENT_MONTH=12",
+                "LODGEMENT_YEAR=2020/LODGEMENT_MONTH=1",
+                "LODGEMENT_YEAR=2020/LODGEMENT_MONTH=3",
+            ],
+        ),
+    ],
+)
+def test_repartition_by_lodgement_date(tmp_path, partition_by, expected_partitions):
+    dataset_path = tmp_path / "staging"
+    dataset_path.mkdir()
+    for part_number, dates in enumerate(
+        [["2020-01-05", "2019-12-31"], ["2020-03-01", "2020-01-20"]]
+    ):
+        pyarrow.parquet.write_table(
+            pyarrow.table(
+                {
+                    "LMK_KEY": [f"{part_number}-{i}" for i in range(len(dates))],
+                    "LODGEMENT_DATE": pyarrow.array(dates).cast(pyarrow.date32()),
+                }
+            ),
+            dataset_path / f"part-{part_number:03}.parquet",
+        )
+
+    output_path = tmp_path / "certificates"
+    repartition_by_lodgement_date(
+        dataset_path,
+        output_path,
+        partition_by,
+        max_open_files=2,
+        compression="zstd",
+        bloom_filter_columns=["LMK_KEY"],
+        page_index=True,
+    )
+
+    partitions = sorted(
+        str(path.parent.relative_to(output_path))
+        for path in output_path.rglob("*.parquet")
+    )
+    assert sorted(set(partitions)) == expected_partitions
+    dataset = pyarrow.dataset.dataset(
+        output_path / "LODGEMENT_YEAR=2020", format="parquet"
+    )
+    assert sorted(dataset.to_table()["LMK_KEY"].to_pylist()) == ["0-0", "1-0", "1-1"]
+    column_chunks = [
+        pyarrow.parquet.read_metadata(path).row_group(0).column(0)
+        for path in output_path.rglob("*.parquet")
+    ]
+    assert {column_chunk.compression for column_chunk in column_chunks} == {"ZSTD"}
+    assert all(column_chunk.bloom_filter_offset for column_chunk in column_chunks)
+    assert all(column_chunk.has_column_index for column_chunk in column_chunks)
+    assert find_rows(output_path, "LMK_KEY", "1-1")["LMK_KEY"].to_pylist() == ["1-1"]
+
+
+def test_pack_parts():
+    part_sizes = {"a": 60, "b": 30, "c": 50, "d": 20, "e": 150}
+    assert pack_parts(part_sizes, target_size=100) == [["e"], ["a", "b"], ["c", "d"]]
+
+
+def test_compact_dataset(tmp_path):
+    dataset_path = tmp_path / "staging"
+    for authority, rows in [("E1", 3), ("E2", 5)]:
+        partition_path = dataset_path / f"LOCAL_AUTHORITY_CODE={authority}"
+        partition_path.mkdir(parents=True)
+        for part_number in range(3):
+            pyarrow.parquet.write_table(
+                pyarrow.table({"LMK_KEY": [f"{authority}-{part_number}"] * rows}),
+                partition_path / f"part-{part_number:03}.parquet",
+                row_group_size=2,
+                sorting_columns=[pyarrow.parquet.SortingColumn(0)],
+            )
+    (dataset_path / "LOCAL_AUTHORITY_CODE=E1" / "_manifest.json").write_text("{}")
+
+    output_path = tmp_path / "certificates"
+    output_path.mkdir()
+    (output_path / "stale.parquet").write_text("")
+    compact_dataset(dataset_path, output_path, target_size=1, rows_per_group=4)
+
+    assert sorted(
+        str(path.relative_to(output_path)) for path in output_path.rglob("*")
+    ) == [
+        "LOCAL_AUTHORITY_CODE=E1",
+        "LOCAL_AUTHORITY_CODE=E1/part-000.parquet",
+        "LOCAL_AUTHORITY_CODE=E1/part-001.parquet",
+        "LOCAL_AUTHORITY_CODE=E1/part-002.parquet",
+        "LOCAL_AUTHORITY_CODE=E2",
+        "LOCAL_AUTHORITY_CODE=E2/part-000.parquet",
+        "LOCAL_AUTHORITY_CODE=E2/part-001.parquet",
+        "LOCAL_AUTHORITY_CODE=E2/part-002.parquet",
+        "_common_metadata",
+        "_metadata",
+    ]
+
+    compact_dataset(
+        dataset_path,
+        output_path,
+        target_size=1024**2,
+        rows_per_group=4,
+        compression="zstd",
+        bloom_filter_columns=["LMK_KEY"],
+        page_index=True,
+    )
+    parquet_file = pyarrow.parquet.ParquetFile(
+        output_path / "LOCAL_AUTHORITY_CODE=E2" / "part-000.parquet"
+    )
+    assert parquet_file.metadata.num_rows == 15
+    column_chunk = parquet_file.metadata.row_group(0).column(0)
+    assert column_chunk.compression == "ZSTD"
+    assert column_chunk.bloom_filter_offset is not None
+    assert column_chunk.has_column_index and column_chunk.has_offset_index
+    assert parquet_file.metadata.row_group(0).sorting_columns == (
+        pyarrow.parquet.SortingColumn(0),
+    )
+    # Row groups are merged up to 4 rows, but never across parts
+    assert [
+        set(parquet_file.read_row_group(i)["LMK_KEY"].to_pylist())
+        for i in range(parquet_file.num_row_groups)
+    ] == [{"E2-0"}, {"E2-0"}, {"E2-1"}, {"E2-1"}, {"E2-2"}, {"E2-2"}]
+
+
+def test_hash_strings():
+    hashes = hash_strings(pyarrow.array(["abc", "abd", "abc", None, "é"]))
+    assert hashes.type == "int64"
+    assert hashes[0] == hashes[2]
+    assert hashes[0] != hashes[1]
+    assert hashes[3] != hashes[4]
+
+
+def test_diff_certificates(tmp_path):
+    previous_path = tmp_path / "previous"
+    previous_path.mkdir()
+    pyarrow.parquet.write_table(
+        pyarrow.table(
+            {
+                "LMK_KEY": ["1", "2", "3", "4"],
+                "POSTCODE": ["A", "B", None, "D"],
+                "UPRN": [1, 2, 3, 4],
+            }
+        ),
+        previous_path / "part-000.parquet",
+    )
+    current_path = tmp_path / "current"
+    current_path.mkdir()
+    pyarrow.parquet.write_table(
+        pyarrow.table(
+            {
+                "LMK_KEY": ["1", "2", "3", "5"],
+                "POSTCODE": pyarrow.array(["A", "B", "C", "E"]).dictionary_encode(),
+                "UPRN": [1, 20, 3, 5],
+            }
+        ),
+        current_path / "part-000.parquet",
+    )
+
+    output_path = tmp_path / "changes"
+    diff_certificates(previous_path, current_path, output_path, partitions=4)
+
+    def keys(change):
+        table = pyarrow.parquet.read_table(output_path / f"{change}.parquet")
+        return sorted(table["LMK_KEY"].to_pylist())
+
+    assert keys("inserted") == ["5"]
+    assert keys("updated") == ["2", "3"]
+    assert keys("deleted") == ["4"]
+    assert sorted(path.name for path in output_path.iterdir()) == [
+        "deleted.parquet",
+        "inserted.parquet",
+        "updated.parquet",
+    ]
+
+
+def test_diff_certificates_narrow_types(tmp_path):
+    # The previous release was converted with narrow types, and a value in the
+    # current one no longer fits them
+    for name, fireplaces, area in [
+        ("previous", pyarrow.array([1, 2], pyarrow.int8()), pyarrow.float32()),
+        ("current", pyarrow.array([1, 1000]), pyarrow.float64()),
+    ]:
+        (tmp_path / name).mkdir()
+        pyarrow.parquet.write_table(
+            pyarrow.table(
+                {
+                    "LMK_KEY": ["1", "2"],
+                    "NUMBER_OPEN_FIREPLACES": fireplaces,
+                    "ENVIRONMENT_IMPACT_CURRENT": pyarrow.array([72.5, 80], area),
+                }
+            ),
+            tmp_path / name / "part-000.parquet",
+        )
+
+    output_path = tmp_path / "changes"
+    diff_certificates(tmp_path / "previous", tmp_path / "current", output_path)
+    updated = pyarrow.parquet.read_table(output_path / "updated.parquet")
+    assert updated["LMK_KEY"].to_pylist() == ["2"]
+
+
+def test_latest_certificates(tmp_path):
+    dataset_path = tmp_path / "certificates"
+    dataset_path.mkdir()
+    for part_number, rows in enumerate(
+        [
+            [
+                ("1", 100, 1, "2015-01-01 10:00:00"),
+                ("2", 100, 1, "2020-06-01 09:00:00"),
+                ("3", None, 7, "2012-01-01 09:00:00"),
+                ("4", None, None, "2013-01-01 09:00:00"),
+            ],
+            [
+                ("5", 100, 1, "2018-01-01 09:00:00"),
+                ("6", None, 7, "2019-01-01 09:00:00"),
+                ("7", 200, 7, "2019-01-01 09:00:00"),
+                ("8", None, None, "2014-01-01 09:00:00"),
+            ],
+        ]
+    ):
+        lmk_keys, uprns, building_references, lodgement_datetimes = zip(*rows)
+        pyarrow.parquet.write_table(
+            pyarrow.table(
+                {
+                    "LMK_KEY": lmk_keys,
+                    "UPRN": pyarrow.array(uprns, pyarrow.int64()),
+                    "BUILDING_REFERENCE_NUMBER": pyarrow.array(
+                        building_references, pyarrow.int64()
+                    ),
+                    "LODGEMENT_DATETIME": pyarrow.array(lodgement_datetimes).cast(
+                        pyarrow.timestamp("s")
+                    ),
+                }
+            ),
+            dataset_path / f"part-{part_number:03}.parquet",
+        )
+
+    output_path = tmp_path / "latest"
+    latest_certificates(dataset_path, output_path, partitions=4)
+
+    latest = pyarrow.dataset.dataset(output_path, format="parquet").to_table()
+    assert sorted(latest["LMK_KEY"].to_pylist()) == ["2", "4", "6", "7", "8"]
+    assert latest.column_names == [
+        "LMK_KEY",
+        "UPRN",
+        "BUILDING_REFERENCE_NUMBER",
+        "LODGEMENT_DATETIME",
+    ]
+
+
 def test_parse_args():
     args = parse_args(["archive.zip", "destination"])
     assert args.epc_zipfile == "archive.zip"
     assert args.output_path == "destination"
+    assert args.block_size is None
+    assert args.workers == 1
+    assert args.compression == "snappy"
+
+
+def test_parse_args_filter():
+    args = parse_args(
+        ["a.zip", "out", "--filter", 'field("LODGEMENT_DATE") >= date(2015, 1, 1)']
+    )
+    table = pyarrow.table(
+        {"LODGEMENT_DATE": pyarrow.array(["2014-12-31", "2015-01-01"]).cast("date32")}
+    )
+    assert table.filter(args.filter).num_rows == 1
+
+    args = parse_args(["a.zip", "out", "--filter", 'field("UPRN").isin([1, 2.5])'])
+    assert pyarrow.table({"UPRN": [1, 2, 3]}).filter(args.filter).num_rows == 1
+
+    args = parse_args(
+        [
+            "a.zip",
+            "out",
+            "--filter",
+            '1 < field("UPRN") and not pc.equal(field("UPRN"), 3)',
+        ]
+    )
+    assert pyarrow.table({"UPRN": [1, 2, 3]}).filter(args.filter).num_rows == 1
+
+    # Filters are built from an allow-list rather than evaluated
+    for value in [
+        '__import__("os").getcwd()',
+        'open("/etc/passwd")',
+        "[c for c in ().__class__.__base__.__subclasses__()][0]()._module",
+        'field("UPRN").__class__',
+        "1 + 1",
+    ]:
+        with pytest.raises(SystemExit):
+            parse_args(["a.zip", "out", "--filter", value])
+
+
+def test_parse_args_key_index_row_group_size():
+    assert parse_args(["a.zip", "out", "--key-index"]).row_group_size == 16384
+    args = parse_args(["a.zip", "out", "--key-index", "--row-group-size", "1000"])
+    assert args.row_group_size == 1000
+    args = parse_args(["a.zip", "out", "--key-index", "--row-group-size", "100000"])
+    assert args.row_group_size == 16384
+    assert parse_args(["a.zip", "out"]).row_group_size is None
+
+
+def test_parse_args_unknown_columns():
+    with pytest.raises(SystemExit):
+        parse_args(["archive.zip", "destination", "--columns", "POSTCODE,NOPE"])
+
+
+def test_epc_datasets_columns():
+    certificates, recommendations = epc_datasets("out", ["POSTCODE", "UPRN"])
+    assert list(certificates[1]) == ["LMK_KEY", "POSTCODE", "UPRN"]
+    assert recommendations[1] == RECOMMENDATIONS_SCHEMA
+
+
+def test_parse_args_column_compression():
+    args = parse_args(
+        [
+            "archive.zip",
+            "destination",
+            "--column-compression",
+            "*_DESCRIPTION=zstd:9",
+            "--column-compression",
+            "UPRN=lz4",
+        ]
+    )
+    assert args.column_compression == [
+        ("*_DESCRIPTION", ("zstd", 9)),
+        ("UPRN", ("lz4", None)),
+    ]
+
+
+def test_parse_args_previous_certificates_without_cache():
+    with pytest.raises(SystemExit):
+        parse_args(["a.zip", "out", "--previous-certificates", "x", "--cache-dir", "c"])
+
+
+def test_generate_epc_zip(tmp_path):
+    zip_path = tmp_path / "generated.zip"
+    generate_epc_zip(zip_path, size_mb=4, seed=1)
+    with zipfile.ZipFile(zip_path) as zip_file:
+        members = zip_file.infolist()
+        first_csv = zip_file.read(members[0])
+    assert members[0].filename.endswith("/certificates.csv")
+    assert members[1].filename.endswith("/recommendations.csv")
+    assert len(members) > 2
+    assert 3.5 * 1024**2 < sum(member.file_size for member in members) < 4.5 * 1024**2
+
+    generate_epc_zip(tmp_path / "again.zip", size_mb=4, seed=1)
+    with zipfile.ZipFile(tmp_path / "again.zip") as zip_file:
+        assert zip_file.read(members[0].filename) == first_csv
+
+    output_path = tmp_path / "parquet_files"
+    convert_datasets(zip_path, epc_datasets(output_path))
+    certificates = open_dataset(output_path / "certificates").to_table()
+    assert certificates.column_names == list(CERTIFICATE_SCHEMA)
+    assert certificates["LMK_KEY"].null_count == 0
+    assert pyarrow.compute.count_distinct(certificates["LMK_KEY"]).as_py() == (
+        certificates.num_rows
+    )
+    recommendations = open_dataset(output_path / "recommendations").to_table()
+    assert recommendations.column_names == list(RECOMMENDATIONS_SCHEMA)
+
+
+def test_benchmark(tmp_path):
+    zip_path = tmp_path / "generated.zip"
+    generate_epc_zip(zip_path, size_mb=1, seed=1)
+    results = benchmark(zip_path, tmp_path / "work")
+
+    assert list(results["stages"]) == ["certificates", "recommendations"]
+    assert list(results["stages"]["certificates"]) == STAGES
+    assert results["stages"]["certificates"]["parse"]["rows_per_second"] > 0
+    assert results["conversion"]["peak_rss_mb"] > 0
+    json.dumps(results)
+
+    assert compare_results(results, results) == []
+    slower = json.loads(json.dumps(results))
+    slower["stages"]["certificates"]["encode"]["mb_per_second"] /= 2
+    assert compare_results(results, slower) == [("certificates encode", -0.5)]
+
+    # A conversion too quick to time has no throughput to compare
+    instant = json.loads(json.dumps(results))
+    instant["conversion"]["mb_per_second"] = None
+    assert compare_results(instant, results) == []
+    assert compare_results(results, instant) == []